@@ -0,0 +1,230 @@
+# Per-kernel benchmark of the PBF solver.
+# Sweeps the scene scale (particle count) and the particle spacing `delta` (neighbor density),
+# times every kernel of a step separately and writes the results to a json file.
+# usage: python benchmark.py run --scales 0.5 1 1.5 --deltas 1.05 0.8 --out bench.json
+#        python benchmark.py run --set cell_list_mode=compact --out compact.json
+#        python benchmark.py compare old.json new.json
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import config
+from headless_main import parse_override
+
+kernels = ['prologue', 'PBF_solver', 'epilogue', 'apply_vorticity_confinement', 'apply_xsph_viscosity']
+
+
+def scene_overrides(scale, spacing):
+    # scale the fluid blocks; the tank grows with them so that the blocks stay inside
+    return {
+        'tank_width': config.tank_width * scale,
+        'tank_height': config.tank_height * scale,
+        'tank_depth': config.tank_depth * scale,
+        'fluid_blocks_1_start': [v * scale for v in config.fluid_blocks_1_start],
+        'fluid_blocks_1_end': [v * scale for v in config.fluid_blocks_1_end],
+        'fluid_blocks_2_start': [v * scale for v in config.fluid_blocks_2_start],
+        'fluid_blocks_2_end': [v * scale for v in config.fluid_blocks_2_end],
+        'delta': spacing,
+    }
+
+
+def run_case(overrides, arch, threads, steps, warmup):
+    # runs in a fresh process: config has to be overridden before the solver modules are imported
+    config.configure(**overrides)
+    import taichi as ti
+    from headless_main import init_taichi, build_simulation
+    init_taichi(arch, threads)
+    ps, solver = build_simulation()
+
+    for _ in range(warmup):
+        solver.run_PBF()
+    ti.sync()
+
+    timings = {name: [] for name in kernels}
+
+    def timed(name, kernel=None):
+        # sync before and after so that only this kernel is measured
+        kernel = kernel or getattr(solver, name)
+        ti.sync()
+        t = time.perf_counter()
+        kernel()
+        ti.sync()
+        timings[name].append(time.perf_counter() - t)
+
+    step_times = []
+    for _ in range(steps):
+        t = time.perf_counter()
+        timed('prologue')
+        if config.fused_solver:
+            # one launch for all iterations, reported as the PBF_solver time of the step
+            timed('PBF_solver', solver.PBF_solver_fused)
+        else:
+            for _ in range(config.pdf_num_iters):
+                timed('PBF_solver')
+        timed('epilogue')
+        timed('apply_vorticity_confinement')
+        timed('apply_xsph_viscosity')
+        step_times.append(time.perf_counter() - t)
+
+    # the whole solver phase with a single sync at the end, this includes the python
+    # launch overhead that the per-kernel timings above hide behind their syncs
+    phase_times = []
+    for _ in range(steps):
+        ti.sync()
+        t = time.perf_counter()
+        if config.fused_solver:
+            solver.PBF_solver_fused()
+        else:
+            for _ in range(config.pdf_num_iters):
+                solver.PBF_solver()
+        ti.sync()
+        phase_times.append(time.perf_counter() - t)
+
+    num_neighbors = ps.particle_num_neighbors.to_numpy()[:ps.num_particles[None]]
+    result = {
+        'num_particles': config.N_fluid_particles,
+        'grid_size': list(config.grid_size),
+        'avg_neighbors': float(num_neighbors.mean()),
+        'max_neighbors': int(num_neighbors.max()),
+        'step': summarize(step_times),
+        'solver_phase': summarize(phase_times),
+        'kernels': {},
+    }
+    for name, samples in timings.items():
+        result['kernels'][name] = summarize(samples)
+        # time spent in this kernel per step, over all of its launches
+        result['kernels'][name]['per_step'] = sum(samples) / steps
+    return result
+
+
+def summarize(samples):
+    samples = np.asarray(samples)
+    return {
+        'calls': len(samples),
+        'mean': float(samples.mean()),
+        'median': float(np.median(samples)),
+        'min': float(samples.min()),
+        'max': float(samples.max()),
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.realpath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    import taichi as ti
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'taichi': '.'.join(str(v) for v in ti.__version__),
+            'arch': args.arch,
+            'threads': args.threads,
+            'steps': args.steps,
+            'warmup': args.warmup,
+            'pdf_num_iters': config.pdf_num_iters,
+            'overrides': dict(args.overrides),
+        },
+        'cases': [],
+    }
+    ctx = multiprocessing.get_context('spawn')
+    for scale in args.scales:
+        for spacing in args.deltas:
+            overrides = scene_overrides(scale, spacing)
+            overrides.update(args.overrides)
+            # one process per case, the kernels are compiled against the overridden config
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+                result = executor.submit(run_case, overrides, args.arch, args.threads,
+                                         args.steps, args.warmup).result()
+            case = {'scale': scale, 'delta': spacing}
+            case.update(result)
+            report['cases'].append(case)
+            print_case(case)
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.out}")
+
+
+def print_case(case):
+    print(f"scale {case['scale']}  delta {case['delta']}  particles {case['num_particles']}  "
+          f"avg neighbors {case['avg_neighbors']:.1f}  step {case['step']['median'] * 1e3:.2f} ms")
+    for name in kernels:
+        k = case['kernels'][name]
+        share = k['per_step'] / case['step']['mean'] * 100
+        print(f"    {name:<30} {k['median'] * 1e3:9.3f} ms/call  {k['calls']:5d} calls  {share:5.1f}% of step")
+    print(f"    {'solver phase, one sync':<30} {case['solver_phase']['median'] * 1e3:9.3f} ms")
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    old_cases = {(c['scale'], c['delta']): c for c in old['cases']}
+    print(f"old: {old['meta'].get('revision')}  new: {new['meta'].get('revision')}")
+    regressed = False
+    for case in new['cases']:
+        key = (case['scale'], case['delta'])
+        if key not in old_cases:
+            continue
+        print(f"scale {key[0]}  delta {key[1]}  particles {case['num_particles']}")
+        for name in kernels:
+            t_old = old_cases[key]['kernels'][name]['per_step']
+            t_new = case['kernels'][name]['per_step']
+            ratio = t_new / t_old
+            flag = ''
+            if ratio > 1.0 + args.threshold:
+                flag = '  <- regression'
+                regressed = True
+            elif ratio < 1.0 - args.threshold:
+                flag = '  <- faster'
+            print(f"    {name:<30} {t_old * 1e3:9.3f} ms -> {t_new * 1e3:9.3f} ms  x{ratio:.2f}{flag}")
+    return regressed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Per-kernel benchmark of the PBF solver.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help='run the benchmark sweep')
+    p.add_argument('--scales', type=float, nargs='+', default=[1.0],
+                   help='scale of the fluid blocks (and the tank), the particle count grows with scale^3')
+    p.add_argument('--deltas', type=float, nargs='+', default=[config.delta], help='particle spacing')
+    p.add_argument('--steps', type=int, default=20)
+    p.add_argument('--warmup', type=int, default=2)
+    p.add_argument('--arch', default='cpu')
+    p.add_argument('--threads', type=int, default=0)
+    p.add_argument('--out', default='bench.json')
+    p.add_argument('--set', dest='overrides', type=parse_override, action='append', default=[],
+                   metavar='NAME=VALUE', help='override a parameter of config.py for every case')
+
+    p = sub.add_parser('compare', help='compare two result files per kernel')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1, help='relative change reported as regression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'run':
+        run(args)
+    else:
+        if compare(args):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
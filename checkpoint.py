@@ -0,0 +1,109 @@
+# Checkpoint / restart of the simulation state.
+# A checkpoint is an uncompressed .npz with the particle state, the step count and the config parameters.
+import glob
+import json
+import os
+import re
+import numpy as np
+import config
+
+checkpoint_pattern = 'checkpoint_{:08d}.npz'
+
+# per particle state, only the particles in use are stored
+state_fields = ['positions', 'old_positions', 'velocities', 'colors', 'particle_ids']
+
+
+# parameters of config.py that can be stored as json
+def config_snapshot():
+    snapshot = {}
+    for name, value in vars(config).items():
+        if name.startswith('_') or callable(value):
+            continue
+        if isinstance(value, (bool, int, float, str)):
+            snapshot[name] = value
+        elif isinstance(value, (list, tuple)) and all(isinstance(v, (bool, int, float, str)) for v in value):
+            snapshot[name] = list(value)
+    return snapshot
+
+
+def save_checkpoint(path, ps, solver, step):
+    n = ps.num_particles[None]
+    state = {name: getattr(ps, name).to_numpy()[:n] for name in state_fields}
+    state.update({
+        'num_particles': np.array(n),
+        'board_states': np.array(ps.board_states[None]),
+        'step': np.array(step),
+        'solver_steps': np.array(solver.num_steps),
+        'config': np.array(json.dumps(config_snapshot())),
+        # runtime parameters, they may differ from config.py
+        'params': np.array(json.dumps(solver.params.values)),
+    })
+    # write to a temporary file first, a crash while writing never leaves a broken checkpoint behind
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(tmp_path, path)
+
+
+# restores the state into @ps and @solver and returns the step count of the checkpoint
+def load_checkpoint(path, ps, solver):
+    with np.load(path) as data:
+        saved_config = json.loads(str(data['config']))
+        # older checkpoints stored the whole fields without the count
+        n = int(data['num_particles']) if 'num_particles' in data else data['positions'].shape[0]
+        if n != config.N_fluid_particles:
+            raise ValueError(f"checkpoint {path} has {n} particles, "
+                             f"the current config has {config.N_fluid_particles}")
+        if n > config.max_num_particles:
+            raise ValueError(f"checkpoint {path} has {n} particles, "
+                             f"the particle capacity is {config.max_num_particles}")
+        current = config_snapshot()
+        changed = [name for name, value in saved_config.items() if name in current and current[name] != value]
+        if changed:
+            print(f"checkpoint {path}: parameters changed since it was written: {', '.join(sorted(changed))}")
+
+        for name in state_fields:
+            # the free slots past n keep their current values
+            f = getattr(ps, name)
+            values = f.to_numpy()
+            values[:n] = data[name][:n]
+            f.from_numpy(values)
+        ps.num_particles[None] = n
+        ps.board_states[None] = float(data['board_states'])
+        solver.num_steps = int(data['solver_steps'])
+        if 'params' in data:
+            solver.params.set(**json.loads(str(data['params'])))
+        step = int(data['step'])
+        # the telemetry frame numbers continue from there
+        solver.num_frames = step
+    # neighbor lists kept for reuse belong to the state before the restore
+    solver.neighbors_valid = False
+    return step
+
+
+def checkpoint_path(directory, step):
+    return os.path.join(directory, checkpoint_pattern.format(step))
+
+
+def list_checkpoints(directory):
+    checkpoints = []
+    for path in glob.glob(os.path.join(directory, 'checkpoint_*.npz')):
+        match = re.fullmatch(r'checkpoint_(\d+)\.npz', os.path.basename(path))
+        if match:
+            checkpoints.append((int(match.group(1)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+# removes all but the @keep newest checkpoints, @keep >= 1
+def prune_checkpoints(directory, keep):
+    if keep < 1:
+        # [:-0] would keep everything and a negative count would delete the newest ones
+        raise ValueError(f"keep has to be at least 1, got {keep}")
+    for path in list_checkpoints(directory)[:-keep]:
+        os.remove(path)
@@ -11,31 +11,29 @@ dim = 3
 gravity = ti.Vector([0,-9.8,0])
 # time step slot
 time_delta = 1.0 / 20.0
+# adaptive time step: every run_PBF still advances time_delta, split into equal substeps that are short
+# enough that no particle moves more than cfl_number * h in one substep
+adaptive_timestep = False
+cfl_number = 0.4
+max_substeps = 8
 # epsilon in equation
 epsilon = 1e-5
 
 # water tank parameters
 tank_width, tank_height, tank_depth = 50, 50, 30
-# boundary
-boundary = (tank_depth, tank_height, tank_width)
 
 cell_size = 2.5
-cell_recpr = 1.0 / cell_size
 
 def round_up(f, s):
     return (math.floor(f * cell_recpr / s) + 1) * s
 
-
-grid_size = (round_up(boundary[0], 1), round_up(boundary[1], 1), round_up(boundary[2], 1))
-
 # Gui parameters
 background_color = (1.0, 1.0, 1.0)
 
 # particle parameters
 # The radius of particle
 particle_radius = 0.15
-particle_diameter = 2*particle_radius
-delta = particle_diameter * 3.5
+delta = 2 * particle_radius * 3.5
 # The number of fluid particles
 fluid_blocks = 1
 fluid_block_loc = (0,0,0)
@@ -44,27 +42,48 @@ fluid_blocks_1_end = [30, 35, 20]
 fluid_blocks_2_start = [5,15, 30]
 fluid_blocks_2_end = [30, 35, 40]
 
-fluid_blocks_1_x = len(np.arange(fluid_blocks_1_start[0], fluid_blocks_1_end[0], delta))
-fluid_blocks_1_y = len(np.arange(fluid_blocks_1_start[1], fluid_blocks_1_end[1], delta))
-fluid_blocks_1_z = len(np.arange(fluid_blocks_1_start[2], fluid_blocks_1_end[2], delta))
-fluid_blocks_2_x = len(np.arange(fluid_blocks_2_start[0], fluid_blocks_2_end[0], delta))
-fluid_blocks_2_y = len(np.arange(fluid_blocks_2_start[1], fluid_blocks_2_end[1], delta))
-fluid_blocks_2_z = len(np.arange(fluid_blocks_2_start[2], fluid_blocks_2_end[2], delta))
-
-N_fluid_1_particles = 1
-N_fluid_2_particles = 1
-
 color1 = ti.Vector([50/255,100/255,200/255])
 color2 = ti.Vector([50/255,200/255,100/255])
 
-for i in range(dim):
-    N_fluid_1_particles *= len(np.arange(fluid_blocks_1_start[i], fluid_blocks_1_end[i], delta))
-    N_fluid_2_particles *= len(np.arange(fluid_blocks_2_start[i], fluid_blocks_2_end[i], delta))
-
-N_fluid_particles = N_fluid_1_particles + N_fluid_2_particles
 # pre-defined parameter
+# particle fields are allocated for this many particles, 0 allocates N_fluid_particles.
+# Only the first particle_system.num_particles are simulated.
+particle_capacity = 0
+# initial sizes of the cell and neighbor tables, see capacity_check
 max_num_particles_per_cell = 100
 max_num_neighbors = 100
+# cell list used by the neighbor search
+# 'dense'   - grid2particles table with max_num_particles_per_cell slots per cell
+# 'compact' - per-cell counts + exclusive prefix sum, particle indices sorted by cell in one array of length N
+# 'sparse'  - the dense table split into blocks of sparse_block_size^3 cells that are only allocated where
+#             particles are, memory follows the fluid instead of the tank volume
+# 'hash'    - like 'compact', but cells are hashed into hash_table_size buckets, works for any coordinates
+cell_list_mode = 'dense'
+sparse_block_size = 4
+# buckets of the 'hash' cell list, 0 picks the next power of two >= 2 * max_num_particles
+hash_table_size = 0
+# no tank walls, particles may leave boundary; needs cell_list_mode = 'hash'
+open_domain = False
+# neighbor list layout
+# 'dense' - particle_neighbors table with max_num_neighbors slots per particle
+# 'csr'   - per-particle counts, prefix-summed offsets and one flat index array
+neighbor_list_mode = 'dense'
+# capacity of the flat csr array, in neighbors per particle on average
+csr_neighbors_per_particle = 40
+# overflow checks of the cell and neighbor buffers after every neighbor list build
+# 'off'    - no checks, entries that do not fit are dropped silently
+# 'count'  - count the dropped entries and track the peak occupancy
+# 'resize' - like 'count', and grow the buffers and build the lists again when entries were dropped
+capacity_check = 'resize'
+# a grown buffer holds the peak occupancy times resize_headroom
+resize_headroom = 1.25
+# Verlet skin: neighbor lists are searched within neighbour_radius + neighbor_skin and reused
+# until a particle has moved more than neighbor_skin / 2 since the last build, 0 rebuilds every step
+neighbor_skin = 0.0
+# sort the particle arrays spatially every reorder_interval steps, 0 disables the reordering
+reorder_interval = 0
+# sort key: 'cell' - linear cell index, 'morton' - Z-order of the cell coordinates
+reorder_key = 'cell'
 
 rigid_body_path = "./Dragon_50k.obj"
 num_particles_obj = 0
@@ -72,8 +91,8 @@ num_particles_obj = 0
 # PBF parameters
 # kernel radius
 h = 1.1
-# neighbour radius
-neighbour_radius = h * 1.05
+# neighbors are searched within neighbour_radius = neighbour_radius_ratio * h, also for a runtime h (solver_params.py)
+neighbour_radius_ratio = 1.05
 # fluid mass
 mass = 1.0
 # fluid density
@@ -82,6 +101,27 @@ rho0 = 1.0
 lambda_epsilon = 100.0
 # sub_step number
 pdf_num_iters = 5
+# stop the solver iterations once the density error max(C_i, 0) is at most solver_tolerance,
+# after at least min_solver_iters and at most max_solver_iters iterations. 0 always runs pdf_num_iters
+solver_tolerance = 0.0
+# 'max' or 'mean' of the density error over the particles
+solver_error_norm = 'max'
+min_solver_iters = 1
+max_solver_iters = 10
+# run all solver iterations in one kernel launch instead of one launch per iteration
+fused_solver = False
+# store the spiky gradient and poly6 value of every neighbor pair next to the neighbor list in the lambda loop
+# and read them in the position delta loop, instead of evaluating the kernels twice per iteration
+cache_pair_kernels = False
+# store every neighbor pair once, with the lower particle index, and add its terms to both particles with atomics.
+# Halves the pair evaluations and the size of the csr neighbor list; the neighbor counts (capacities, telemetry)
+# are per half list. The sums are added up in a different order, so results differ from the full lists in rounding,
+# and with several threads from run to run
+half_neighbor_list = False
+# how the pair loops of the half lists add to the other particle:
+# 'atomic' - parallel loops with atomic adds, 'serial' - one thread, the atomics are compiled to plain adds,
+# 'auto'   - 'serial' when the cpu backend runs a single thread, 'atomic' otherwise
+half_list_scatter = 'auto'
 # correction parameter
 corr_deltaQ_coeff = 0.3
 corrK = 0.001
@@ -93,41 +133,126 @@ spiky_grad_factor = -45.0 / math.pi
 
 @ti.func
 def get_cell(pos):
-    return int(pos * cell_recpr)
+    # floor, so that cells stay cell_size wide for negative coordinates
+    return ti.floor(pos * cell_recpr, int)
 
 @ti.func
 def is_in_grid(c):
     # @c: Vector(i32)
-    return 0 <= c[0] and c[0] < grid_size[0] and 0 <= c[1] and c[
-        1] < grid_size[1] and c[2] >= 0 and c[2] < grid_size[2] 
+    result = True
+    # the hashed cell list has every cell
+    if ti.static(cell_list_mode != 'hash'):
+        result = 0 <= c[0] and c[0] < grid_size[0] and 0 <= c[1] and c[
+            1] < grid_size[1] and c[2] >= 0 and c[2] < grid_size[2]
+    return result
 
 @ti.func
-def poly6_value(s, h):
+def get_cell_hash(c):
+    # Teschner et al. 2003, the products wrap around in 32 bit
+    return ((c[0] * 73856093) ^ (c[1] * 19349663) ^ (c[2] * 83492791)) & (num_hash_buckets - 1)
+
+@ti.func
+def get_cell_index(c):
+    # index of the cell @c in [0, num_cell_indices): linear index, or the bucket for the hashed cell list
+    index = 0
+    if ti.static(cell_list_mode == 'hash'):
+        index = get_cell_hash(c)
+    else:
+        index = (c[0] * grid_size[1] + c[1]) * grid_size[2] + c[2]
+    return index
+
+@ti.func
+def get_morton_code(c):
+    # interleave the bits of the cell coordinates
+    code = 0
+    for b in ti.static(range(morton_bits)):
+        for d in ti.static(range(dim)):
+            code |= ((c[d] >> b) & 1) << (b * dim + d)
+    return code
+
+# SPH kernels of a pair. @prm: the solver_params struct, its h2 = h^2, poly6_coeff = poly6_factor / h^9
+# and spiky_coeff = spiky_grad_factor / h^6 are computed once per parameter change instead of per pair
+@ti.func
+def poly6_value(s, prm):
     result = 0.0
-    if 0 < s and s < h:
-        x = (h * h - s * s) / (h * h * h)
-        result = poly6_factor * x * x * x
+    if 0 < s and s < prm.h:
+        x = prm.h2 - s * s
+        result = prm.poly6_coeff * x * x * x
     return result
 
 @ti.func
-def spiky_gradient(r, h):
-    result = ti.Vector([0.0, 0.0, 0.0])
-    r_len = r.norm()
-    if 0 < r_len and r_len < h:
-        x = (h - r_len) / (h * h * h)
-        g_factor = spiky_grad_factor * x * x
-        result = r * g_factor / r_len
-    return result
+def spiky_gradient(r, prm):
+    return spiky_gradient_norm(r, r.norm(), prm)
 
+# same as spiky_gradient, with the length of @r known
 @ti.func
-def compute_scorr(pos_ji):
-    # Eq (13)
-    x = poly6_value(pos_ji.norm(), h) / poly6_value(corr_deltaQ_coeff * h, h)
-    # pow(x, 4)
-    x = ti.pow(x,4)
-    return (corrK) * x
+def spiky_gradient_norm(r, r_len, prm):
+    result = ti.Vector([0.0, 0.0, 0.0])
+    if 0 < r_len and r_len < prm.h:
+        x = prm.h - r_len
+        result = r * (prm.spiky_coeff * x * x / r_len)
+    return result
 
 vorticity_confinement_epsilon = 0.3
 XSPH_c = 0.01
 outputInterval = 40
-series_prefix = "./output/particle_object_output_{}.ply"
\ No newline at end of file
+series_prefix = "./output/particle_object_output_{}.ply"
+# 'ply' (binary), 'ply_ascii', 'npz' (compressed), 'raw' (float32 x, y, z, r, g, b)
+# or 'trajectory' (all frames appended to one memory-mappable file, see trajectory.py)
+export_format = 'ply'
+# frames that may wait for the background writer before the simulation blocks
+export_queue_size = 4
+# per-step metrics (phase wall times, density error, neighbor counts, ...) written every telemetry_interval steps
+# to telemetry_path, .jsonl or .csv, see telemetry.py. 0 disables them
+telemetry_interval = 0
+telemetry_path = "./output/telemetry.jsonl"
+# neighbor count histogram: bins 0 ... telemetry_histogram_bins - 2, the last bin counts all longer lists
+telemetry_histogram_bins = 16
+
+# derived parameters
+def update_derived():
+    global boundary, cell_recpr, grid_size, num_grid_cells, morton_bits, particle_diameter
+    global num_hash_buckets, num_cell_indices, sorted_cell_list, max_num_particles
+    global neighbour_radius, neighbor_search_radius
+    global fluid_blocks_1_x, fluid_blocks_1_y, fluid_blocks_1_z
+    global fluid_blocks_2_x, fluid_blocks_2_y, fluid_blocks_2_z
+    global N_fluid_1_particles, N_fluid_2_particles, N_fluid_particles
+    # boundary
+    boundary = (tank_depth, tank_height, tank_width)
+    cell_recpr = 1.0 / cell_size
+    grid_size = (round_up(boundary[0], 1), round_up(boundary[1], 1), round_up(boundary[2], 1))
+    num_grid_cells = grid_size[0] * grid_size[1] * grid_size[2]
+    morton_bits = (max(grid_size) - 1).bit_length()
+    particle_diameter = 2 * particle_radius
+    # neighbour radius
+    neighbour_radius = h * neighbour_radius_ratio
+    neighbor_search_radius = neighbour_radius + neighbor_skin
+
+    fluid_blocks_1_x = len(np.arange(fluid_blocks_1_start[0], fluid_blocks_1_end[0], delta))
+    fluid_blocks_1_y = len(np.arange(fluid_blocks_1_start[1], fluid_blocks_1_end[1], delta))
+    fluid_blocks_1_z = len(np.arange(fluid_blocks_1_start[2], fluid_blocks_1_end[2], delta))
+    fluid_blocks_2_x = len(np.arange(fluid_blocks_2_start[0], fluid_blocks_2_end[0], delta))
+    fluid_blocks_2_y = len(np.arange(fluid_blocks_2_start[1], fluid_blocks_2_end[1], delta))
+    fluid_blocks_2_z = len(np.arange(fluid_blocks_2_start[2], fluid_blocks_2_end[2], delta))
+    N_fluid_1_particles = fluid_blocks_1_x * fluid_blocks_1_y * fluid_blocks_1_z
+    N_fluid_2_particles = fluid_blocks_2_x * fluid_blocks_2_y * fluid_blocks_2_z
+    N_fluid_particles = N_fluid_1_particles + N_fluid_2_particles
+    max_num_particles = particle_capacity or N_fluid_particles
+
+    # a power of two, get_cell_hash masks instead of taking the modulo
+    num_hash_buckets = 1 << (max(hash_table_size or 2 * max_num_particles, 2) - 1).bit_length()
+    # range of get_cell_index
+    num_cell_indices = num_hash_buckets if cell_list_mode == 'hash' else num_grid_cells
+    # the cell list is one array of particle indices sorted by get_cell_index
+    sorted_cell_list = cell_list_mode in ('compact', 'hash')
+
+update_derived()
+
+# Override parameters of this module and refresh the derived ones.
+# Modules use `from config import *`, so this has to run before particle/pbf are imported.
+def configure(**overrides):
+    for name, value in overrides.items():
+        if name not in globals():
+            raise KeyError(f"unknown config parameter: {name}")
+        globals()[name] = value
+    update_derived()
@@ -0,0 +1,299 @@
+# Domain decomposition over worker processes.
+# The tank is split into slabs along one axis and every slab is simulated by its own process with its own
+# taichi runtime, so the particle fields, neighbor lists and cell lists of one process only hold one slab.
+# At the start of every step the workers hand over the particles that left their slab and copy the particles
+# within halo_width of a slab boundary to the neighbor as ghosts. Ghosts are simulated like owned particles,
+# but their positions are overwritten with the owner's after the prediction and after every solver iteration,
+# so the owned particles see the same neighbors as in a single process.
+# usage: python domain.py --workers 4 --threads 2 --steps 200 --set cell_list_mode='hash'
+#        python domain.py --workers 2 --steps 50 --profile --trace ./output/trace.json
+import argparse
+import contextlib
+import io
+import math
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+import taichi as ti
+import config
+from headless_main import init_taichi, parse_override
+from profiler import trace_profiler
+
+# per-particle state that is handed over with a particle, in the layout of the particle_system fields
+state_fields = ['positions', 'velocities', 'colors', 'particle_ids']
+
+
+# initial particles of the two fluid blocks, same layout as particle_system.init_particles
+def initial_particles():
+    positions, colors = [], []
+    blocks = [
+        (config.fluid_blocks_1_start, config.fluid_blocks_1_x, config.fluid_blocks_1_y, config.fluid_blocks_1_z, config.color1),
+        (config.fluid_blocks_2_start, config.fluid_blocks_2_x, config.fluid_blocks_2_y, config.fluid_blocks_2_z, config.color2),
+    ]
+    for start, nx, ny, nz, color in blocks:
+        i = np.arange(nx * ny * nz)
+        cell = np.stack([i % nx, i // (nx * nz), (i // nx) % nz], axis=1)
+        positions.append(np.asarray(start) + cell * config.delta)
+        colors.append(np.tile(np.asarray(list(color)), (len(i), 1)))
+    positions = np.concatenate(positions).astype(np.float32)
+    return {
+        'positions': positions,
+        'velocities': np.zeros_like(positions),
+        'colors': np.concatenate(colors).astype(np.float32),
+        'particle_ids': np.arange(len(positions), dtype=np.int32),
+    }
+
+
+def select(state, mask):
+    return {name: values[mask] for name, values in state.items()}
+
+
+def concatenate(states):
+    return {name: np.concatenate([s[name] for s in states]) for name in state_fields}
+
+
+# sends payloads[side] to the neighbor on each side (0 - lower, 1 - upper) and returns what the neighbors sent.
+# Sends run on threads: both sides of a pipe send first, a large message would block both of them otherwise.
+def exchange(conns, payloads):
+    senders = []
+    for conn, payload in zip(conns, payloads):
+        if conn is not None:
+            senders.append(threading.Thread(target=conn.send, args=(payload,)))
+            senders[-1].start()
+    received = [conn.recv() if conn is not None else None for conn in conns]
+    for sender in senders:
+        sender.join()
+    return received
+
+
+@ti.kernel
+def gather(f: ti.template(), indices: ti.types.ndarray(), out: ti.types.ndarray()):
+    for k in range(indices.shape[0]):
+        for c in ti.static(range(config.dim)):
+            out[k, c] = f[indices[k]][c]
+
+
+@ti.kernel
+def scatter(f: ti.template(), offset: int, values: ti.types.ndarray()):
+    for k in range(values.shape[0]):
+        for c in ti.static(range(config.dim)):
+            f[offset + k][c] = values[k, c]
+
+
+class slab_worker:
+    # @lower, @upper: slab bounds along @axis, -inf / inf for the outermost slabs
+    # @conns: pipes to the lower and upper neighbor, None at the ends
+    def __init__(self, ps, solver, state, lower, upper, axis, halo_width, conns):
+        self.ps = ps
+        self.solver = solver
+        self.state = state
+        self.lower = lower
+        self.upper = upper
+        self.axis = axis
+        self.halo_width = halo_width
+        self.conns = conns
+        self.exchange_time = 0.0
+        self.max_ghosts = 0
+        solver.sync_ghosts = self.sync_ghosts
+
+    def step(self):
+        t = time.perf_counter()
+        with self.solver.timer.phase('exchange'):
+            self.migrate()
+            self.build_halo()
+        self.exchange_time += time.perf_counter() - t
+        with self.solver.timer.phase('upload'):
+            self.upload()
+        self.solver.run_PBF()
+        with self.solver.timer.phase('download'):
+            self.download()
+
+    # hands over the particles that left the slab
+    def migrate(self):
+        x = self.state['positions'][:, self.axis]
+        below, above = x < self.lower, x >= self.upper
+        received = exchange(self.conns, [select(self.state, below), select(self.state, above)])
+        self.state = concatenate([select(self.state, ~(below | above))] + [r for r in received if r is not None])
+
+    # sends copies of the particles near the slab bounds, they stay the same until the next step
+    def build_halo(self):
+        x = self.state['positions'][:, self.axis]
+        self.send_indices = [np.nonzero(x < self.lower + self.halo_width)[0].astype(np.int32),
+                             np.nonzero(x >= self.upper - self.halo_width)[0].astype(np.int32)]
+        received = exchange(self.conns, [select(self.state, i) for i in self.send_indices])
+        self.ghosts = [r for r in received if r is not None]
+        self.num_owned = len(self.state['positions'])
+        # ghost slots of the lower and upper neighbor, after the owned particles
+        num_lower = len(received[0]['positions']) if received[0] is not None else 0
+        self.ghost_offsets = [self.num_owned, self.num_owned + num_lower]
+        self.max_ghosts = max(self.max_ghosts, sum(len(g['positions']) for g in self.ghosts))
+
+    def upload(self):
+        local = concatenate([self.state] + self.ghosts)
+        n = len(local['positions'])
+        if n > config.max_num_particles:
+            raise RuntimeError(f"slab [{self.lower}, {self.upper}) holds {n} particles with ghosts, "
+                               f"its capacity is {config.max_num_particles}; raise --capacity-factor")
+        for name in state_fields:
+            f = getattr(self.ps, name)
+            values = np.zeros(f.shape + local[name].shape[1:], dtype=local[name].dtype)
+            values[:n] = local[name]
+            f.from_numpy(values)
+        self.ps.num_particles[None] = n
+
+    def download(self):
+        for name in ['positions', 'velocities']:
+            self.state[name] = getattr(self.ps, name).to_numpy()[:self.num_owned]
+
+    # replaces the ghost positions with the owners' predicted positions
+    def sync_ghosts(self):
+        t = time.perf_counter()
+        with self.solver.timer.phase('ghosts'):
+            payloads = []
+            for indices in self.send_indices:
+                out = np.zeros((len(indices), config.dim), dtype=np.float32)
+                if len(indices) > 0:
+                    gather(self.ps.positions, indices, out)
+                payloads.append(out)
+            received = exchange(self.conns, payloads)
+            for offset, values in zip(self.ghost_offsets, received):
+                if values is not None and len(values) > 0:
+                    scatter(self.ps.positions, offset, values)
+        self.exchange_time += time.perf_counter() - t
+
+
+def worker_main(rank, state, lower, upper, args, capacity, overrides, conns, result_conn):
+    config.configure(particle_capacity=capacity, **overrides)
+    init_taichi(args.arch, args.threads, kernel_profiler=args.profile)
+    from particle import particle_system
+    from pbf import pbf
+    ps = particle_system()
+    ps.board_states[None] = 0.0
+    solver = pbf(ps)
+    if args.profile:
+        solver.timer.profiler = trace_profiler()
+    worker = slab_worker(ps, solver, state, lower, upper, args.axis, args.halo_width, conns)
+
+    worker.step()
+    ti.sync()
+    if args.profile:
+        # the first step is dominated by the compilation
+        solver.timer.profiler.reset()
+    start = time.perf_counter()
+    worker.exchange_time = 0.0
+    for _ in range(args.steps - 1):
+        worker.step()
+    ti.sync()
+    wall_time = time.perf_counter() - start
+    summary = None
+    if args.profile:
+        # one trace per slab, the summary is printed by the parent so that the slabs do not interleave
+        os.makedirs(os.path.dirname(os.path.abspath(args.trace)), exist_ok=True)
+        solver.timer.profiler.write_trace(rank_trace_path(args.trace, rank))
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            solver.timer.profiler.print_summary()
+        summary = out.getvalue()
+    result_conn.send({
+        'rank': rank,
+        'wall_time': wall_time,
+        'exchange_time': worker.exchange_time,
+        'num_owned': worker.num_owned,
+        'max_ghosts': worker.max_ghosts,
+        'profile': summary,
+        'state': worker.state,
+    })
+
+
+# trace.json -> trace_slab0.json, trace_slab1.json, ...
+def rank_trace_path(path, rank):
+    base, ext = os.path.splitext(path)
+    return f"{base}_slab{rank}{ext}"
+
+
+# runs @args.steps steps on args.workers slabs and returns the final particle state sorted by id and the worker stats
+def run(args, overrides):
+    config.configure(**overrides)
+    for name in ['fused_solver', 'solver_tolerance', 'adaptive_timestep', 'neighbor_skin', 'reorder_interval']:
+        # these need values of all particles within a step, or keep particle indices across steps
+        if getattr(config, name):
+            raise ValueError(f"{name} is not supported with the domain decomposition")
+    state = initial_particles()
+    n = len(state['positions'])
+    # slabs with equal initial particle counts
+    x = state['positions'][:, args.axis]
+    bounds = [-math.inf] + [float(np.quantile(x, k / args.workers)) for k in range(1, args.workers)] + [math.inf]
+    capacity = int(math.ceil(args.capacity_factor * n / args.workers))
+    # ghosts only come from the adjacent slabs
+    if any(upper - lower < args.halo_width for lower, upper in zip(bounds[1:-1], bounds[2:-1])):
+        raise ValueError(f"slabs are thinner than the halo width {args.halo_width}, use fewer workers")
+
+    ctx = multiprocessing.get_context('spawn')
+    pipes = [ctx.Pipe() for _ in range(args.workers - 1)]
+    results = []
+    processes = []
+    for rank in range(args.workers):
+        lower, upper = bounds[rank], bounds[rank + 1]
+        conns = [pipes[rank - 1][1] if rank > 0 else None, pipes[rank][0] if rank < args.workers - 1 else None]
+        result_recv, result_send = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=worker_main, name=f'slab_{rank}',
+                        args=(rank, select(state, (x >= lower) & (x < upper)), lower, upper, args, capacity,
+                              overrides, conns, result_send))
+        p.start()
+        processes.append(p)
+        results.append(result_recv)
+    stats = [r.recv() for r in results]
+    for p in processes:
+        p.join()
+
+    final = concatenate([s.pop('state') for s in stats])
+    order = np.argsort(final['particle_ids'])
+    return {name: values[order] for name, values in final.items()}, stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the PBF solver on slabs in separate processes.')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--arch', default='cpu')
+    parser.add_argument('--threads', type=int, default=1, help='cpu threads per worker')
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--axis', type=int, default=0, help='slabs are cut perpendicular to this axis')
+    parser.add_argument('--halo-width', type=float, default=None,
+                        help='ghost layer thickness, 2 * neighbor search radius + h by default')
+    parser.add_argument('--capacity-factor', type=float, default=2.0,
+                        help='particle slots per worker, relative to an even share of the particles')
+    parser.add_argument('--out', help='write the final positions and velocities to this .npz file')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the step phases and the kernel tasks of every slab, print a summary and write a trace per slab')
+    parser.add_argument('--trace', default='./output/trace.json',
+                        help='chrome / perfetto trace of --profile, slab k writes <name>_slab<k><ext>')
+    parser.add_argument('--set', dest='overrides', type=parse_override, action='append', default=[],
+                        metavar='NAME=VALUE', help='override a parameter of config.py')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    overrides = dict(args.overrides)
+    config.configure(**overrides)
+    if args.halo_width is None:
+        # the lambdas of the ghosts next to the slab need their own neighbors, that is two search radii;
+        # h on top for particles that move towards the slab during a step
+        args.halo_width = 2 * config.neighbor_search_radius + config.h
+    final, stats = run(args, overrides)
+    for s in sorted(stats, key=lambda s: s['rank']):
+        timed = args.steps - 1
+        print(f"slab {s['rank']}: {s['num_owned']} particles, up to {s['max_ghosts']} ghosts, "
+              f"{timed / s['wall_time']:.2f} steps/s, exchange {s['exchange_time'] / s['wall_time'] * 100:.1f}% of the time")
+        if s['profile'] is not None:
+            print(s['profile'], end='')
+            print(f"trace written to {rank_trace_path(args.trace, s['rank'])}")
+    if args.out:
+        np.savez(args.out, **final)
+        print(f"final state written to {args.out}")
+    return final, stats
+
+
+if __name__ == '__main__':
+    main()
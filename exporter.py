@@ -0,0 +1,137 @@
+# Frame export. Frames are copied to host memory on the calling thread and written
+# to disk by a background thread, so the solver keeps stepping while earlier frames flush.
+import os
+import queue
+import threading
+import numpy as np
+import taichi as ti
+import config
+from trajectory import trajectory_writer
+
+# file extension per export format
+extensions = {
+    'ply_ascii': '.ply',
+    'ply': '.ply',
+    'npz': '.npz',
+    'raw': '.bin',
+    'trajectory': '.traj',
+}
+
+
+# positions and colors of the particles in use as (N, 3) float32 arrays, in the initial particle order
+def snapshot(ps):
+    # the fields may have free slots past num_particles (config.particle_capacity)
+    n = ps.num_particles[None]
+    positions = ps.positions.to_numpy()[:n]
+    colors = ps.colors.to_numpy()[:n]
+    if config.reorder_interval > 0:
+        # keep the vertex order stable across frames
+        order = ps.get_export_order()
+        positions, colors = positions[order], colors[order]
+    return positions, colors
+
+
+# same naming as ti.tools.PLYWriter.export_frame: <prefix>_<frame:06d><ext>
+def frame_path(series_prefix, frame, file_format):
+    base, ext = os.path.splitext(series_prefix)
+    if ext != '.ply':
+        base = series_prefix
+    if file_format == 'trajectory':
+        # all frames go into one file
+        return base.replace('{}', 'trajectory') + extensions[file_format]
+    return f"{base}_{frame:06d}{extensions[file_format]}"
+
+
+def write_ply_ascii(path, positions, colors):
+    writer = ti.tools.PLYWriter(num_vertices=positions.shape[0])
+    writer.add_vertex_pos(positions[:, 0], positions[:, 1], positions[:, 2])
+    writer.add_vertex_color(colors[:, 0], colors[:, 1], colors[:, 2])
+    writer.export_ascii(path)
+
+
+def write_ply(path, positions, colors):
+    # binary little endian, same vertex properties as the ascii export
+    names = ['x', 'y', 'z', 'red', 'green', 'blue']
+    vertices = np.empty(positions.shape[0], dtype=[(name, '<f4') for name in names])
+    for i in range(3):
+        vertices[names[i]] = positions[:, i]
+        vertices[names[i + 3]] = colors[:, i]
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {positions.shape[0]}']
+    header += [f'property float {name}' for name in names]
+    header += ['end_header']
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        vertices.tofile(f)
+
+
+def write_npz(path, positions, colors):
+    np.savez_compressed(path, positions=positions, colors=colors)
+
+
+def write_raw(path, positions, colors):
+    # headerless float32 x, y, z, r, g, b per particle
+    np.hstack([positions, colors]).astype('<f4').tofile(path)
+
+
+writers = {
+    'ply_ascii': write_ply_ascii,
+    'ply': write_ply,
+    'npz': write_npz,
+    'raw': write_raw,
+}
+
+
+class frame_writer:
+    # @max_pending: frames that may wait in memory, submit blocks while the queue is full
+    def __init__(self, series_prefix, file_format='ply', max_pending=4):
+        if file_format not in extensions:
+            raise ValueError(f"unknown export format: {file_format}")
+        self.series_prefix = series_prefix
+        self.file_format = file_format
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.frames_written = 0
+        self.trajectory = None
+        os.makedirs(os.path.dirname(os.path.abspath(series_prefix)), exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='frame_writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, frame, ps):
+        self.check_error()
+        positions, colors = snapshot(ps)
+        self.queue.put((frame, positions, colors))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, positions, colors = item
+            try:
+                path = frame_path(self.series_prefix, frame, self.file_format)
+                if self.file_format == 'trajectory':
+                    # positions only, colors stay with the particle ids
+                    if self.trajectory is None:
+                        self.trajectory = trajectory_writer(path, positions.shape[0])
+                    self.trajectory.write_frame(frame, positions)
+                else:
+                    writers[self.file_format](path, positions, colors)
+                self.frames_written += 1
+            except Exception as e:
+                # reported on the next submit or close, keep draining so that submit never blocks forever
+                self.error = e
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # waits for the pending frames
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.trajectory is not None:
+            self.trajectory.close()
+            self.trajectory = None
+        self.check_error()
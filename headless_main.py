@@ -0,0 +1,215 @@
+# Headless batch runner. Advances the PBF solver without a GGUI window,
+# reports throughput and writes frames on a schedule.
+# usage: python headless_main.py --arch cpu --threads 8 --steps 1000 --output-interval 40 --set cell_list_mode=compact
+#        python headless_main.py --steps 200 --output-interval 0 --profile --trace ./output/trace.json
+import argparse
+import ast
+import os
+import time
+import taichi as ti
+import config
+from exporter import frame_writer, extensions
+from telemetry import telemetry_sink
+from profiler import trace_profiler
+from checkpoint import save_checkpoint, load_checkpoint, checkpoint_path, latest_checkpoint, prune_checkpoints
+
+archs = {
+    'cpu': ti.cpu,
+    'gpu': ti.gpu,
+    'cuda': ti.cuda,
+    'vulkan': ti.vulkan,
+    # ti.gpu falls back to the cpu backend when no gpu is available
+    'auto': ti.gpu,
+}
+
+
+def init_taichi(arch='cpu', threads=0, **kwargs):
+    if threads > 0:
+        kwargs['cpu_max_num_threads'] = threads
+    ti.init(arch=archs[arch], **kwargs)
+
+
+def build_simulation():
+    # imported here so that config overrides are applied before the kernels see the parameters
+    from particle import particle_system
+    from pbf import pbf
+    ps = particle_system()
+    ps.init_particles()
+    solver = pbf(ps)
+    return ps, solver
+
+
+def run(ps, solver, steps, start_step=0, warmup=1, output_interval=0, writer=None, log_interval=0,
+        checkpoint_interval=0, checkpoint_dir=None, keep_checkpoints=2):
+    # runs the steps start_step + 1 ... steps, the first warm-up steps trigger the JIT compilation and are not timed
+    first_timed = min(start_step + warmup, steps)
+    export_time = 0.0
+    checkpoint_time = 0.0
+    frames = 0
+    start_solver_steps = solver.num_steps
+    start_solver_iters = solver.total_solver_iters
+    start = time.perf_counter()
+    for step in range(start_step + 1, steps + 1):
+        if step == first_timed + 1:
+            ti.sync()
+            if solver.timer.profiler is not None:
+                # the warm-up steps are dominated by the compilation
+                solver.timer.profiler.reset()
+            start = time.perf_counter()
+        solver.run_PBF()
+        if output_interval > 0 and writer is not None and step % output_interval == 0:
+            # only the copy to host memory (and waiting for a full queue) blocks the simulation
+            t = time.perf_counter()
+            with solver.timer.phase('export'):
+                # frame numbers follow the step count, so a resumed run continues the series
+                writer.submit(step // output_interval - 1, ps)
+            export_time += time.perf_counter() - t
+            frames += 1
+        if checkpoint_interval > 0 and checkpoint_dir is not None and step % checkpoint_interval == 0:
+            t = time.perf_counter()
+            with solver.timer.phase('checkpoint'):
+                save_checkpoint(checkpoint_path(checkpoint_dir, step), ps, solver, step)
+                prune_checkpoints(checkpoint_dir, keep_checkpoints)
+            checkpoint_time += time.perf_counter() - t
+        if log_interval > 0 and step % log_interval == 0 and step > first_timed:
+            ti.sync()
+            elapsed = time.perf_counter() - start
+            line = f"step {step}/{steps}  {(step - first_timed) / elapsed:.2f} steps/s"
+            if config.solver_tolerance > 0:
+                line += f"  solver iterations {solver.solver_iters}  density error {solver.last_density_error:.3g}"
+            print(line)
+    ti.sync()
+    elapsed = time.perf_counter() - start
+    flush_time = 0.0
+    if writer is not None:
+        t = time.perf_counter()
+        writer.close()
+        flush_time = time.perf_counter() - t
+
+    timed_steps = steps - first_timed
+    return {
+        'steps': steps - start_step,
+        # more than steps with the adaptive time step
+        'solver_steps': solver.num_steps - start_solver_steps,
+        'solver_iters_per_step': (solver.total_solver_iters - start_solver_iters) / max(solver.num_steps - start_solver_steps, 1),
+        'timed_steps': timed_steps,
+        'num_particles': config.N_fluid_particles,
+        'wall_time': elapsed,
+        'export_time': export_time,
+        'checkpoint_time': checkpoint_time,
+        'flush_time': flush_time,
+        'frames_written': frames,
+        'steps_per_sec': timed_steps / elapsed if timed_steps > 0 else 0.0,
+        'particle_steps_per_sec': timed_steps * config.N_fluid_particles / elapsed if timed_steps > 0 else 0.0,
+        'capacity': solver.capacity_stats(),
+    }
+
+
+# argparse type of counts that have to be at least 1
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return value
+
+
+def parse_override(text):
+    # name=value, value is parsed as a python literal and kept as a string otherwise
+    name, _, value = text.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name.strip(), value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the PBF solver without a window.')
+    parser.add_argument('--arch', choices=sorted(archs), default='cpu')
+    parser.add_argument('--threads', type=int, default=0, help='cpu threads, 0 uses all cores')
+    parser.add_argument('--steps', type=int, default=1000, help='total number of steps, including resumed ones')
+    parser.add_argument('--warmup', type=int, default=1, help='steps at the start that are not timed')
+    parser.add_argument('--output-interval', type=int, default=config.outputInterval,
+                        help='write a frame every N steps, 0 disables the export')
+    parser.add_argument('--output-dir', default='./output')
+    parser.add_argument('--format', choices=sorted(extensions), help='export format, config.export_format by default')
+    parser.add_argument('--log-interval', type=int, default=100)
+    parser.add_argument('--checkpoint-interval', type=int, default=0, help='save a checkpoint every N steps')
+    parser.add_argument('--checkpoint-dir', default='./checkpoints')
+    parser.add_argument('--keep-checkpoints', type=positive_int, default=2,
+                        help='newest checkpoints kept on disk, at least 1')
+    parser.add_argument('--resume', nargs='?', const='latest', metavar='PATH',
+                        help='restart from a checkpoint file, or from the newest one in --checkpoint-dir')
+    parser.add_argument('--telemetry', metavar='PATH', help='write per-step metrics to this .jsonl or .csv file, '
+                        'config.telemetry_path by default when config.telemetry_interval is set')
+    parser.add_argument('--telemetry-interval', type=int, help='steps between telemetry records')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the step phases and the kernel tasks, print a summary and write a trace')
+    parser.add_argument('--trace', default='./output/trace.json', help='chrome / perfetto trace of --profile')
+    parser.add_argument('--set', dest='overrides', type=parse_override, action='append', default=[],
+                        metavar='NAME=VALUE', help='override a parameter of config.py')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config.configure(**dict(args.overrides))
+    if args.telemetry_interval is not None:
+        config.configure(telemetry_interval=args.telemetry_interval)
+    elif args.telemetry is not None and config.telemetry_interval <= 0:
+        # a path without an interval records every step
+        config.configure(telemetry_interval=1)
+    init_taichi(args.arch, args.threads, kernel_profiler=args.profile)
+    ps, solver = build_simulation()
+    if args.profile:
+        solver.timer.profiler = trace_profiler()
+
+    start_step = 0
+    if args.resume is not None:
+        path = latest_checkpoint(args.checkpoint_dir) if args.resume == 'latest' else args.resume
+        if path is None:
+            print(f"no checkpoint in {args.checkpoint_dir}, starting from step 0")
+        else:
+            start_step = load_checkpoint(path, ps, solver)
+            print(f"resumed from {path} at step {start_step}")
+
+    if config.telemetry_interval > 0:
+        solver.telemetry = telemetry_sink(args.telemetry or config.telemetry_path)
+
+    writer = None
+    if args.output_interval > 0:
+        writer = frame_writer(os.path.join(args.output_dir, os.path.basename(config.series_prefix)),
+                              args.format or config.export_format, config.export_queue_size)
+
+    stats = run(ps, solver, args.steps, start_step=start_step, warmup=args.warmup,
+                output_interval=args.output_interval, writer=writer, log_interval=args.log_interval,
+                checkpoint_interval=args.checkpoint_interval, checkpoint_dir=args.checkpoint_dir,
+                keep_checkpoints=args.keep_checkpoints)
+    if solver.telemetry is not None:
+        solver.telemetry.close()
+    print(f"particles:            {stats['num_particles']}")
+    print(f"steps:                {stats['steps']} ({stats['solver_steps']} solver steps)")
+    print(f"wall time:            {stats['wall_time']:.3f} s (export {stats['export_time']:.3f} s, "
+          f"checkpoints {stats['checkpoint_time']:.3f} s, final flush {stats['flush_time']:.3f} s)")
+    print(f"frames written:       {stats['frames_written']}")
+    print(f"solver iterations:    {stats['solver_iters_per_step']:.2f} per solver step")
+    if config.capacity_check != 'off':
+        c = stats['capacity']
+        cells = f"up to {c['peak_cell_particles']} particles per cell"
+        if 'cell_capacity' in c:
+            cells += f" of {c['cell_capacity']} ({c['cell_overflows']} dropped)"
+        print(f"cell list:            {cells}")
+        print(f"neighbor lists:       up to {c['peak_neighbors']} neighbors, capacity {c['neighbor_capacity']} "
+              f"({c['neighbor_overflows']} dropped), {c['resizes']} resizes")
+    print(f"steps/sec:            {stats['steps_per_sec']:.2f}")
+    print(f"particle-steps/sec:   {stats['particle_steps_per_sec']:.4g}")
+    if args.profile:
+        os.makedirs(os.path.dirname(os.path.abspath(args.trace)), exist_ok=True)
+        solver.timer.profiler.write_trace(args.trace)
+        solver.timer.profiler.print_summary()
+        print(f"trace written to {args.trace}")
+    return stats
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,19 @@ import taichi as ti
 from config import *
 from particle import particle_system
 from pbf import pbf
+from exporter import frame_writer
+from telemetry import telemetry_sink
+from profiler import trace_profiler
+import argparse
 import os
 
-ti.init(arch=ti.gpu)  # 确定后端
+parser = argparse.ArgumentParser(description='Run the PBF solver in a GGUI window.')
+parser.add_argument('--profile', action='store_true',
+                    help='time the step phases and the kernel tasks, print a summary and write a trace on exit')
+parser.add_argument('--trace', default='./output/trace.json', help='chrome / perfetto trace of --profile')
+args = parser.parse_args()
+
+ti.init(arch=ti.gpu, kernel_profiler=args.profile)  # 确定后端
 
 # 初始化数据
 width, height = 900, 600
@@ -17,6 +27,10 @@ print(fluid_blocks_1_z)
 ps.init_particles()
 # ps.add_rigid_body()
 solver = pbf(ps)
+if args.profile:
+    solver.timer.profiler = trace_profiler()
+if telemetry_interval > 0:
+    solver.telemetry = telemetry_sink(os.path.join(os.path.dirname(os.path.realpath(__file__)), telemetry_path))
 
 # Water tank parameters
 tank_vertex = ti.Vector.field(3, dtype=ti.f32, shape=8)
@@ -66,6 +80,16 @@ output_as_ply = 0
 current_directory = os.path.dirname(os.path.realpath(__file__))
 movedir = 1
 time_period = 0
+writer = None
+# solver parameters with a slider, (minimum, maximum)
+slider_ranges = {
+    'lambda_epsilon': (1.0, 500.0),
+    'corrK': (0.0, 0.01),
+    'XSPH_c': (0.0, 0.1),
+    'vorticity_confinement_epsilon': (0.0, 1.0),
+    # the search radius h * neighbour_radius_ratio + neighbor_skin has to fit into a cell
+    'h': (0.8, min(2.3, (cell_size - neighbor_skin) / neighbour_radius_ratio)),
+}
 
 while window.running:
     # 初始化设置
@@ -81,6 +105,15 @@ while window.running:
         start_simulation = gui.button("Start Simulation")
         export_as_ply = gui.button("Export as PLY")
         reset_scene = gui.button("reset_scene")
+        # applied from the next step on, the kernels are not recompiled
+        for name, (minimum, maximum) in slider_ranges.items():
+            value = gui.slider_float(name, solver.params.get(name), minimum=minimum, maximum=maximum)
+            if value != solver.params.get(name):
+                try:
+                    solver.params.set(**{name: value})
+                except ValueError:
+                    # rounding of the slider past the limit, the previous value stays
+                    pass
 
         # value = gui.slider_float("name1", value, minimum=0, maximum=100)
         # color = gui.color_edit_3("name2", color)
@@ -93,6 +126,9 @@ while window.running:
             time_period-=1
             ps.move_board(movedir)
         solver.run_PBF()
+        if step_count == 1 and solver.timer.profiler is not None:
+            # the first step is dominated by the compilation
+            solver.timer.profiler.reset()
     if export_as_ply:
         output_as_ply = 1
         count_output = 0
@@ -146,18 +182,22 @@ while window.running:
     if run_simulate==1:
         if output_as_ply == 1:
             if step_count % outputInterval == 0:
-                if(count_output==0):
-                    os.makedirs(os.path.join(current_directory,"output"), exist_ok=True)
-
-                np_pos = np.reshape(ps.positions.to_numpy(), (N_fluid_particles, 3))
-                np_rgb = np.reshape(ps.colors.to_numpy(), (N_fluid_particles, 3))
-                # create a PLYWriter
-                writer = ti.tools.PLYWriter(num_vertices=N_fluid_particles)
-                writer.add_vertex_pos(np_pos[:, 0], np_pos[:, 1], np_pos[:, 2])
-                writer.add_vertex_color(
-                    np_rgb[:, 0], np_rgb[:, 1], np_rgb[:, 2])
-                writer.export_frame_ascii(count_output, os.path.join(current_directory,series_prefix))
+                if writer is None:
+                    # frames are written by a background thread
+                    writer = frame_writer(os.path.join(current_directory,series_prefix), export_format, export_queue_size)
+                writer.submit(count_output, ps)
                 count_output = count_output + 1
     
-    canvas.scene(scene)
-    window.show()
\ No newline at end of file
+    with solver.timer.phase('render'):
+        canvas.scene(scene)
+        window.show()
+
+if writer is not None:
+    writer.close()
+if solver.telemetry is not None:
+    solver.telemetry.close()
+if args.profile:
+    os.makedirs(os.path.dirname(os.path.abspath(args.trace)), exist_ok=True)
+    solver.timer.profiler.write_trace(args.trace)
+    solver.timer.profiler.print_summary()
+    print(f"trace written to {args.trace}")
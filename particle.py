@@ -1,6 +1,7 @@
 # deal with particles
 import taichi as ti
 from config import *
+from prefix_sum import prefix_sum
 import numpy as np
 import trimesh as tm
 
@@ -10,6 +11,96 @@ class Material:
     Rigid = 1
     Foam = 3
 
+
+# The cell and neighbor lists as the kernels see them. The tables that capacity_check = 'resize' grows are
+# reallocated by resize_buffers, which hands out a new list_tables for them. Kernels take it as a ti.template()
+# argument, so taichi compiles them once more for the new object instead of launching them on the freed fields.
+@ti.data_oriented
+class list_tables:
+    def __init__(self, ps):
+        self.cell_capacity = ps.cell_capacity
+        self.max_neighbors = ps.max_neighbors
+        self.neighbor_capacity = ps.neighbor_capacity
+        self.grid_num_particles = ps.grid_num_particles
+        self.grid2particles = ps.grid2particles
+        if cell_list_mode == 'sparse':
+            self.grid_blocks = ps.grid_blocks
+        if sorted_cell_list:
+            self.grid_cell_start = ps.grid_cell_start
+            self.particle_cell = ps.particle_cell
+            self.particle_cell_rank = ps.particle_cell_rank
+        self.particle_num_neighbors = ps.particle_num_neighbors
+        self.particle_neighbors = ps.particle_neighbors
+        if neighbor_list_mode == 'csr':
+            self.particle_neighbor_offsets = ps.particle_neighbor_offsets
+        if cache_pair_kernels:
+            self.pair_gradients = ps.pair_gradients
+            self.pair_weights = ps.pair_weights
+
+    # range [begin, end) of the cell in the cell list, entries are read with get_cell_particle
+    @ti.func
+    def get_cell_range(self, cell):
+        begin, end = 0, 0
+        if ti.static(sorted_cell_list):
+            c = get_cell_index(cell)
+            begin = self.grid_cell_start[c]
+            end = begin + self.grid_num_particles[c]
+        else:
+            # the count goes on past a full cell, the entries that did not fit were dropped
+            end = ti.min(self.grid_num_particles[cell], self.cell_capacity)
+        return begin, end
+
+    @ti.func
+    def get_cell_particle(self, cell, k):
+        p = 0
+        if ti.static(sorted_cell_list):
+            p = self.grid2particles[k]
+        else:
+            p = self.grid2particles[cell, k]
+        return p
+
+    # j-th neighbor of p_i, j < particle_num_neighbors[p_i]
+    @ti.func
+    def get_neighbor(self, p_i, j):
+        p_j = 0
+        if ti.static(neighbor_list_mode == 'csr'):
+            p_j = self.particle_neighbors[self.particle_neighbor_offsets[p_i] + j]
+        else:
+            p_j = self.particle_neighbors[p_i, j]
+        return p_j
+
+    @ti.func
+    def set_neighbor(self, p_i, j, p_j):
+        if ti.static(neighbor_list_mode == 'csr'):
+            self.particle_neighbors[self.particle_neighbor_offsets[p_i] + j] = p_j
+        else:
+            self.particle_neighbors[p_i, j] = p_j
+
+    # kernel values of p_i and its j-th neighbor, see cache_pair_kernels
+    @ti.func
+    def set_pair_kernels(self, p_i, j, gradient, weight):
+        if ti.static(neighbor_list_mode == 'csr'):
+            k = self.particle_neighbor_offsets[p_i] + j
+            self.pair_gradients[k] = gradient
+            self.pair_weights[k] = weight
+        else:
+            self.pair_gradients[p_i, j] = gradient
+            self.pair_weights[p_i, j] = weight
+
+    @ti.func
+    def get_pair_kernels(self, p_i, j):
+        gradient = ti.Vector([0.0, 0.0, 0.0])
+        weight = 0.0
+        if ti.static(neighbor_list_mode == 'csr'):
+            k = self.particle_neighbor_offsets[p_i] + j
+            gradient = self.pair_gradients[k]
+            weight = self.pair_weights[k]
+        else:
+            gradient = self.pair_gradients[p_i, j]
+            weight = self.pair_weights[p_i, j]
+        return gradient, weight
+
+
 @ti.data_oriented
 class particle_system():    
     def __init__(self) -> None:
@@ -21,28 +112,127 @@ class particle_system():
         self.velocities = ti.Vector.field(dim, float)
         
         self.colors = ti.Vector.field(dim, float)
+        # initial index of the particle stored at each slot, reorder_particles permutes the arrays
+        self.particle_ids = ti.field(int)
         
-        self.grid_num_particles = ti.field(int)
-        self.grid2particles = ti.field(int)
-        self.particle_num_neighbors = ti.field(int)
-        self.particle_neighbors = ti.field(int)
         self.lambdas = ti.field(float)
         
         # 0- x value, 1- board velocity, 2 - time
         # self.board_states = ti.Vector.field(3,float)
         self.board_states = ti.field(float)
+        # particles in use, the slots from num_particles up to max_num_particles are free
+        self.num_particles = ti.field(int)
         
-        ti.root.dense(ti.i, N_fluid_particles).place(self.old_positions, self.positions, self.velocities, self.colors)
-        grid_snode = ti.root.dense(ti.ijk, grid_size)
-        grid_snode.place(self.grid_num_particles)
-        grid_snode.dense(ti.l, max_num_particles_per_cell).place(self.grid2particles)
-        nb_node = ti.root.dense(ti.i, N_fluid_particles)
-        nb_node.place(self.particle_num_neighbors)
-        nb_node.dense(ti.j, max_num_neighbors).place(self.particle_neighbors)
-        ti.root.dense(ti.i, N_fluid_particles).place(self.lambdas, self.position_deltas)
-        ti.root.place(self.board_states)    
+        ti.root.dense(ti.i, max_num_particles).place(self.old_positions, self.positions, self.velocities, self.colors, self.particle_ids)
+        # the fixed size cell and neighbor tables live in their own snode trees, resize_buffers replaces them
+        self.cell_capacity = max_num_particles_per_cell
+        self.max_neighbors = max_num_neighbors
+        self.neighbor_capacity = max_num_particles * csr_neighbors_per_particle
+        if half_neighbor_list:
+            # every pair is stored once. The longest dense list does not shrink as much, the particle with the
+            # lowest index of a neighborhood keeps all of its pairs; capacity_check = 'resize' grows it when needed
+            self.max_neighbors = max(max_num_neighbors // 2, 1)
+            self.neighbor_capacity //= 2
+        self.cell_tree = None
+        self.neighbor_tree = None
+        if cell_list_mode in ('dense', 'sparse'):
+            self.allocate_cell_list()
+        elif sorted_cell_list:
+            # particles sorted by cell: cell c owns grid2particles[grid_cell_start[c] : grid_cell_start[c] + grid_num_particles[c]]
+            # with c = get_cell_index(cell), for 'hash' the particles of all cells in the bucket
+            self.grid_num_particles = ti.field(int)
+            self.grid2particles = ti.field(int)
+            self.grid_cell_start = ti.field(int)
+            self.particle_cell = ti.field(int)
+            self.particle_cell_rank = ti.field(int)
+            ti.root.dense(ti.i, num_cell_indices).place(self.grid_num_particles, self.grid_cell_start)
+            ti.root.dense(ti.i, max_num_particles).place(self.grid2particles, self.particle_cell, self.particle_cell_rank)
+        else:
+            raise ValueError(f"unknown cell_list_mode: {cell_list_mode}")
+        if open_domain and cell_list_mode != 'hash':
+            raise ValueError("open_domain needs cell_list_mode = 'hash'")
+        if neighbor_list_mode == 'csr':
+            # neighbors of p_i: particle_neighbors[particle_neighbor_offsets[p_i] : + particle_num_neighbors[p_i]]
+            self.particle_num_neighbors = ti.field(int)
+            self.particle_neighbor_offsets = ti.field(int)
+            ti.root.dense(ti.i, max_num_particles).place(self.particle_num_neighbors, self.particle_neighbor_offsets)
+        elif neighbor_list_mode != 'dense':
+            raise ValueError(f"unknown neighbor_list_mode: {neighbor_list_mode}")
+        self.allocate_neighbor_list()
+        self.tables = list_tables(self)
+        ti.root.dense(ti.i, max_num_particles).place(self.lambdas, self.position_deltas)
+        ti.root.place(self.board_states, self.num_particles)    
+        if reorder_interval > 0:
+            if reorder_key == 'cell':
+                num_keys = num_cell_indices
+            elif reorder_key == 'morton':
+                if cell_list_mode == 'hash':
+                    raise ValueError("reorder_key = 'morton' needs a bounded grid, use 'cell' with the 'hash' cell list")
+                num_keys = 1 << (dim * morton_bits)
+            else:
+                raise ValueError(f"unknown reorder_key: {reorder_key}")
+            self.sort_keys = ti.field(int)
+            self.sort_ranks = ti.field(int)
+            self.sort_order = ti.field(int)
+            self.sort_buffer = ti.Vector.field(dim, float)
+            self.sort_counts = ti.field(int)
+            self.sort_offsets = ti.field(int)
+            ti.root.dense(ti.i, max_num_particles).place(self.sort_keys, self.sort_ranks, self.sort_order, self.sort_buffer)
+            ti.root.dense(ti.i, num_keys).place(self.sort_counts, self.sort_offsets)
+            self.sort_scan = prefix_sum(num_keys)
     
 
+    # grid2particles with cell_capacity slots per cell
+    def allocate_cell_list(self):
+        self.grid_num_particles = ti.field(int)
+        self.grid2particles = ti.field(int)
+        fb = ti.FieldsBuilder()
+        if cell_list_mode == 'dense':
+            grid_snode = fb.dense(ti.ijk, grid_size)
+        else:
+            # same indexing as 'dense', cells of inactive blocks read as empty
+            num_blocks = tuple((n + sparse_block_size - 1) // sparse_block_size for n in grid_size)
+            self.grid_blocks = fb.pointer(ti.ijk, num_blocks)
+            grid_snode = self.grid_blocks.dense(ti.ijk, sparse_block_size)
+        grid_snode.place(self.grid_num_particles)
+        grid_snode.dense(ti.l, self.cell_capacity).place(self.grid2particles)
+        self.cell_tree = fb.finalize()
+
+    # particle_neighbors with max_neighbors slots per particle, or neighbor_capacity entries for 'csr'
+    def allocate_neighbor_list(self):
+        self.particle_neighbors = ti.field(int)
+        fb = ti.FieldsBuilder()
+        if neighbor_list_mode == 'dense':
+            self.particle_num_neighbors = ti.field(int)
+            nb_node = fb.dense(ti.i, max_num_particles)
+            nb_node.place(self.particle_num_neighbors)
+            nb_node.dense(ti.j, self.max_neighbors).place(self.particle_neighbors)
+        else:
+            fb.dense(ti.i, self.neighbor_capacity).place(self.particle_neighbors)
+        if cache_pair_kernels:
+            # per neighbor slot, kept apart from the indices that the other neighbor loops read
+            self.pair_gradients = ti.Vector.field(dim, float)
+            self.pair_weights = ti.field(float)
+            if neighbor_list_mode == 'dense':
+                nb_node.dense(ti.j, self.max_neighbors).place(self.pair_gradients, self.pair_weights)
+            else:
+                fb.dense(ti.i, self.neighbor_capacity).place(self.pair_gradients, self.pair_weights)
+        self.neighbor_tree = fb.finalize()
+
+    # reallocates the tables with the given capacities, their contents are lost. The kernels see the new ones
+    # through the new self.tables, the old list_tables refers to freed fields and must not be launched on again
+    def resize_buffers(self, cell_capacity=None, max_neighbors=None, neighbor_capacity=None):
+        if cell_capacity is not None:
+            self.cell_tree.destroy()
+            self.cell_capacity = cell_capacity
+            self.allocate_cell_list()
+        if max_neighbors is not None or neighbor_capacity is not None:
+            self.neighbor_tree.destroy()
+            self.max_neighbors = max_neighbors or self.max_neighbors
+            self.neighbor_capacity = neighbor_capacity or self.neighbor_capacity
+            self.allocate_neighbor_list()
+        self.tables = list_tables(self)
+
     def init_particles(self):
         for i in range(N_fluid_1_particles):
             y = i // (fluid_blocks_1_x * fluid_blocks_1_z)
@@ -52,6 +242,7 @@ class particle_system():
             posy = fluid_blocks_1_start[1] + y * delta
             posz = fluid_blocks_1_start[2] + z * delta
             self.positions[i] = ti.Vector([posx, posy,posz])
+            self.particle_ids[i] = i
 
             # self.positions[i] = ti.Vector([i % fluid_blocks_1_end[0],
             #                                i % (fluid_blocks_1_end[0] * fluid_blocks_1_end[2]),
@@ -67,6 +258,7 @@ class particle_system():
             posy = fluid_blocks_2_start[1] + y * delta
             posz = fluid_blocks_2_start[2] + z * delta
             self.positions[i+N_fluid_1_particles] = ti.Vector([posx, posy,posz])
+            self.particle_ids[i+N_fluid_1_particles] = i+N_fluid_1_particles
 
             # self.positions[i] = ti.Vector([i % fluid_blocks_1_end[0],
             #                                i % (fluid_blocks_1_end[0] * fluid_blocks_1_end[2]),
@@ -76,6 +268,7 @@ class particle_system():
             self.colors[i+N_fluid_1_particles] = color2
         # self.board_states = ti.Vector([0, 1, 0.0])
         self.board_states[None] = 0.0
+        self.num_particles[None] = N_fluid_particles
     
     def add_rigid_body(self,scale_factor=15.0,displacement_factor=[10,0,10]):
         mesh = tm.load(rigid_body_path)
@@ -88,9 +281,59 @@ class particle_system():
         self.voxelized_points = ti.Vector.field(dim, ti.f32, num_particles_obj)
         self.voxelized_points.from_numpy(voxelized_points_np)
 
+    # Spatial reordering: counting sort of all particle state by cell index or Z-order,
+    # so that particles close in space are close in memory for the neighbor loops.
+    # Only state that survives a step is permuted; lambdas, deltas and neighbor lists are rebuilt every step.
+    # The free slots from num_particles on are left alone.
+    @ti.kernel
+    def reorder_particles(self):
+        for I in ti.grouped(self.sort_counts):
+            self.sort_counts[I] = 0
+        for i in range(self.num_particles[None]):
+            cell = get_cell(self.positions[i])
+            key = 0
+            if ti.static(reorder_key == 'morton'):
+                key = get_morton_code(cell)
+            else:
+                key = get_cell_index(cell)
+            self.sort_keys[i] = key
+            self.sort_ranks[i] = ti.atomic_add(self.sort_counts[key], 1)
+        self.sort_scan.exclusive(self.sort_counts, self.sort_offsets)
+        # sort_order[k]: particle moved to slot k
+        for i in range(self.num_particles[None]):
+            self.sort_order[self.sort_offsets[self.sort_keys[i]] + self.sort_ranks[i]] = i
+        self.permute(self.positions)
+        self.permute(self.velocities)
+        self.permute(self.colors)
+        # the ids are gathered through sort_ranks, which is free now
+        for k in range(self.num_particles[None]):
+            self.sort_ranks[k] = self.particle_ids[self.sort_order[k]]
+        for k in range(self.num_particles[None]):
+            self.particle_ids[k] = self.sort_ranks[k]
+
+    @ti.func
+    def permute(self, f):
+        for k in range(self.num_particles[None]):
+            self.sort_buffer[k] = f[self.sort_order[k]]
+        for k in range(self.num_particles[None]):
+            f[k] = self.sort_buffer[k]
+
+    # index array that restores the initial particle order: positions.to_numpy()[:num_particles][order] is sorted by id
+    def get_export_order(self):
+        n = self.num_particles[None]
+        order = np.empty(n, dtype=np.int64)
+        order[self.particle_ids.to_numpy()[:n]] = np.arange(n)
+        return order
+
     # function handling boundary conditions
     @ti.func
     def confine_position_to_boundary(self,p):
+        if ti.static(not open_domain):
+            p = self.confine_position_to_tank(p)
+        return p
+
+    @ti.func
+    def confine_position_to_tank(self,p):
         bmin = ti.Vector([0,0,self.board_states[None]+epsilon])+particle_radius
         # bmax = ti.Vector([self.board_states[0], boundary[1]]) - particle_radius
         bmax = ti.Vector([boundary[0], boundary[1], boundary[2]]) - particle_radius
@@ -111,11 +354,9 @@ class particle_system():
         vel_strength = 3
         if 0 < self.board_states[None] + flag * time_delta * vel_strength < boundary[2] / 3:
             self.board_states[None] = self.board_states[None] + flag * time_delta * vel_strength
-        print("flag:", flag)
-        print("board_states:", self.board_states[None])
         
     @ti.kernel
     def add_random_velocities(self,k:int):
-        for i in range(N_fluid_particles):
+        for i in range(self.num_particles[None]):
             self.velocities[i][k] += ti.random()
     
\ No newline at end of file
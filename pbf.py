@@ -3,19 +3,104 @@
 
 import taichi as ti
 from particle import particle_system
+from prefix_sum import prefix_sum
+from solver_params import solver_params
+from telemetry import phase_timer
+import math
+import time
+import numpy as np
 from config import *
 
 # @ti.data_oriented
 # class pbf():
 #     pass
+
+# phases of a step, timed for the telemetry
+step_phases = ['reorder', 'predict', 'neighbors', 'solver', 'epilogue']
+# members of pbf.occupancy, in the order update_neighbors_kernel packs them
+occupancy_names = ['cell_overflows', 'neighbor_overflows', 'max_cell_particles', 'max_neighbors', 'num_neighbors']
+
 @ti.data_oriented
 class pbf:
     def __init__(self, ps):
         self.ps = ps
+        # called whenever the predicted positions have changed, before other particles read them.
+        # The domain decomposition (domain.py) overwrites its ghost particles there
+        self.sync_ghosts = None
+        self.num_steps = 0
+        # run_PBF calls
+        self.num_frames = 0
+        # telemetry_sink that gets a record every telemetry_interval frames, see telemetry.py
+        self.telemetry = None
+        self.timer = phase_timer()
+        self.metrics = ti.Struct.field({
+            'max_density_error': float,
+            'mean_density_error': float,
+            'max_velocity': float,
+        }, shape=())
+        self.neighbor_histogram = ti.field(int, shape=telemetry_histogram_bins)
+        # length of the current (sub)step
+        self.dt = ti.field(float, shape=())
+        self.dt[None] = time_delta
+        self.num_substeps = 1
+        # iterations and density error of the last step, total iterations over all steps
+        self.density_error = ti.field(float, shape=())
+        self.solver_iters = 0
+        self.last_density_error = 0.0
+        self.total_solver_iters = 0
+        if solver_tolerance > 0 and fused_solver:
+            raise ValueError("solver_tolerance needs the error after every iteration, it cannot be used with fused_solver")
+        if capacity_check not in ('off', 'count', 'resize'):
+            raise ValueError(f"unknown capacity_check: {capacity_check}")
+        # of the last neighbor list build: entries dropped from full cells / neighbor lists,
+        # largest cell (bucket for 'hash') and neighbor list, total number of neighbors
+        self.occupancy = ti.Struct.field({
+            'cell_overflows': int,
+            'neighbor_overflows': int,
+            'max_cell_particles': int,
+            'max_neighbors': int,
+            'num_neighbors': int,
+        }, shape=())
+        # over all builds since the start
+        self.peak_cell_particles = 0
+        self.peak_neighbors = 0
+        self.peak_num_neighbors = 0
+        self.total_cell_overflows = 0
+        self.total_neighbor_overflows = 0
+        self.num_resizes = 0
         self.omegas = ti.Vector.field(dim, float)
-        ti.root.dense(ti.i, N_fluid_particles).place(self.omegas)
-        
-    @ti.kernel
+        ti.root.dense(ti.i, max_num_particles).place(self.omegas)
+        if half_list_scatter not in ('auto', 'atomic', 'serial'):
+            raise ValueError(f"unknown half_list_scatter: {half_list_scatter}")
+        # float atomics are compare and swap loops on the cpu, with a single thread they cost more than the
+        # pair evaluations they save. A serialized loop has them replaced by plain adds
+        cfg = ti.lang.impl.current_cfg()
+        single_thread = cfg.arch in (ti.x64, ti.arm64) and cfg.cpu_max_num_threads == 1
+        self.serial_scatter = half_list_scatter == 'serial' or (half_list_scatter == 'auto' and single_thread)
+        if half_neighbor_list:
+            # per-particle sums that both particles of a pair add to
+            self.density_sums = ti.field(float)
+            self.gradient_sums = ti.Vector.field(dim, float)
+            self.gradient_sqr_sums = ti.field(float)
+            self.etas = ti.Vector.field(dim, float)
+            self.velocity_sums = ti.Vector.field(dim, float)
+            ti.root.dense(ti.i, max_num_particles).place(self.density_sums, self.gradient_sums, self.gradient_sqr_sums,
+                                                         self.etas, self.velocity_sums)
+        if sorted_cell_list:
+            self.cell_scan = prefix_sum(num_cell_indices)
+        if neighbor_list_mode == 'csr':
+            self.neighbor_scan = prefix_sum(max_num_particles)
+        # h, lambda_epsilon, corrK, ... read by the kernels at every launch, see solver_params.py
+        self.params = solver_params()
+        self.neighbors_valid = False
+        # params.version at the last build, a new search radius (h) invalidates the lists
+        self.neighbors_version = -1
+        self.num_neighbor_builds = 0
+        if neighbor_skin > 0:
+            # predicted positions at the last neighbor list build
+            self.build_positions = ti.Vector.field(dim, float)
+            ti.root.dense(ti.i, max_num_particles).place(self.build_positions)
+
     def prologue(self):
         # 1: for all particles i do
         # 2:    apply forces v_i ⇐ v_i +∆t f_ext(x_i)
@@ -24,60 +109,289 @@ class pbf:
         # 5: for all particles i do
         # 6:    find neighboring particles Ni(x_i^*)
         # 7: end for
-        
+        with self.timer.phase('predict'):
+            self.predict_positions()
+            if self.sync_ghosts is not None:
+                self.sync_ghosts()
+        with self.timer.phase('neighbors'):
+            if (neighbor_skin <= 0 or not self.neighbors_valid or self.neighbors_version != self.params.version
+                    or self.max_displacement() > 0.5 * neighbor_skin):
+                occupancy = self.update_neighbors()
+                if capacity_check != 'off':
+                    self.check_capacity(occupancy)
+                self.neighbors_valid = True
+                self.neighbors_version = self.params.version
+                self.num_neighbor_builds += 1
+
+    # collects the @occupancy of the last build, see update_neighbors. With capacity_check = 'resize' the overflowing
+    # tables are grown and the lists built again from the same predicted positions, so no step runs on truncated lists
+    def check_capacity(self, occupancy):
+        while True:
+            self.peak_cell_particles = max(self.peak_cell_particles, occupancy['max_cell_particles'])
+            self.peak_neighbors = max(self.peak_neighbors, occupancy['max_neighbors'])
+            self.peak_num_neighbors = max(self.peak_num_neighbors, occupancy['num_neighbors'])
+            self.total_cell_overflows += occupancy['cell_overflows']
+            self.total_neighbor_overflows += occupancy['neighbor_overflows']
+            if capacity_check != 'resize' or (occupancy['cell_overflows'] == 0 and occupancy['neighbor_overflows'] == 0):
+                return
+            sizes = {}
+            if occupancy['cell_overflows'] > 0:
+                sizes['cell_capacity'] = math.ceil(occupancy['max_cell_particles'] * resize_headroom)
+            if occupancy['neighbor_overflows'] > 0:
+                if neighbor_list_mode == 'csr':
+                    sizes['neighbor_capacity'] = math.ceil(occupancy['num_neighbors'] * resize_headroom)
+                else:
+                    sizes['max_neighbors'] = math.ceil(occupancy['max_neighbors'] * resize_headroom)
+            self.ps.resize_buffers(**sizes)
+            self.num_resizes += 1
+            occupancy = self.update_neighbors()
+
+    # capacities and occupancy of the cell and neighbor tables
+    def capacity_stats(self):
+        stats = {
+            'peak_neighbors': self.peak_neighbors,
+            'neighbor_overflows': self.total_neighbor_overflows,
+            'resizes': self.num_resizes,
+        }
+        if neighbor_list_mode == 'csr':
+            stats['neighbor_capacity'] = self.ps.neighbor_capacity
+            stats['peak_num_neighbors'] = self.peak_num_neighbors
+        else:
+            stats['neighbor_capacity'] = self.ps.max_neighbors
+        if not sorted_cell_list:
+            stats['cell_capacity'] = self.ps.cell_capacity
+            stats['cell_overflows'] = self.total_cell_overflows
+        stats['peak_cell_particles'] = self.peak_cell_particles
+        return stats
+
+    @ti.kernel
+    def predict_positions(self):
         # save old positions to be used in Algorithm 1-21(x_i)
-        for i in self.ps.positions:
+        for i in range(self.ps.num_particles[None]):
             self.ps.old_positions[i] = self.ps.positions[i]
         
         # apply gravity within boundary
-        for i in self.ps.positions:
+        for i in range(self.ps.num_particles[None]):
             pos, vel = self.ps.positions[i], self.ps.velocities[i]
-            vel += gravity * time_delta
-            pos += vel * time_delta
+            vel += self.params.field[None].gravity * self.dt[None]
+            pos += vel * self.dt[None]
             self.ps.positions[i] = self.ps.confine_position_to_boundary(pos)    # check whether hit boundary
 
+    @ti.kernel
+    def max_speed(self) -> float:
+        v = 0.0
+        for i in range(self.ps.num_particles[None]):
+            ti.atomic_max(v, self.ps.velocities[i].norm())
+        return v
+
+    # density constraint C_i at the current positions, with the neighbor lists of the last step.
+    # The half lists need sum_pair_densities first, in the same kernel
+    @ti.func
+    def density_constraint(self, lists: ti.template(), p_i, prm):
+        density = 0.0
+        if ti.static(half_neighbor_list):
+            density = self.density_sums[p_i]
+        else:
+            pos_i = self.ps.positions[p_i]
+            for j in range(lists.particle_num_neighbors[p_i]):
+                p_j = lists.get_neighbor(p_i, j)
+                if p_j < 0:
+                    break
+                density += poly6_value((pos_i - self.ps.positions[p_j]).norm(), prm)
+        return prm.mass * density / prm.rho0 - 1.0
+
+    @ti.func
+    def sum_pair_densities(self, lists: ti.template(), prm):
+        if ti.static(half_neighbor_list):
+            for p_i in range(self.ps.num_particles[None]):
+                self.density_sums[p_i] = 0.0
+            ti.loop_config(serialize=self.serial_scatter)
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+                density = 0.0
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    w = poly6_value((pos_i - self.ps.positions[p_j]).norm(), prm)
+                    density += w
+                    ti.atomic_add(self.density_sums[p_j], w)
+                ti.atomic_add(self.density_sums[p_i], density)
+
+    # max and mean of the density error max(C_i, 0)
+    def measure_density_error(self):
+        return self.measure_density_error_kernel(self.ps.tables)
+
+    @ti.kernel
+    def measure_density_error_kernel(self, lists: ti.template()) -> ti.types.vector(2, float):
+        prm = self.params.field[None]
+        self.sum_pair_densities(lists, prm)
+        e_max, e_sum = 0.0, 0.0
+        for p_i in range(self.ps.num_particles[None]):
+            c = ti.max(self.density_constraint(lists, p_i, prm), 0.0)
+            ti.atomic_max(e_max, c)
+            e_sum += c
+        return ti.Vector([e_max, e_sum / self.ps.num_particles[None]])
+
+    # density error, max speed and the neighbor count histogram in one pass, read back by write_telemetry
+    def reduce_metrics(self):
+        self.reduce_metrics_kernel(self.ps.tables)
+
+    @ti.kernel
+    def reduce_metrics_kernel(self, lists: ti.template()):
+        prm = self.params.field[None]
+        n = self.ps.num_particles[None]
+        self.sum_pair_densities(lists, prm)
+        self.metrics[None].max_density_error = 0.0
+        self.metrics[None].mean_density_error = 0.0
+        self.metrics[None].max_velocity = 0.0
+        for b in self.neighbor_histogram:
+            self.neighbor_histogram[b] = 0
+        for p_i in range(n):
+            c = ti.max(self.density_constraint(lists, p_i, prm), 0.0)
+            ti.atomic_max(self.metrics[None].max_density_error, c)
+            self.metrics[None].mean_density_error += c / n
+            ti.atomic_max(self.metrics[None].max_velocity, self.ps.velocities[p_i].norm())
+            b = ti.min(lists.particle_num_neighbors[p_i], telemetry_histogram_bins - 1)
+            ti.atomic_add(self.neighbor_histogram[b], 1)
+
+    # largest distance a particle has moved since the neighbor lists were built
+    @ti.kernel
+    def max_displacement(self) -> float:
+        d = 0.0
+        for i in range(self.ps.num_particles[None]):
+            ti.atomic_max(d, (self.ps.positions[i] - self.build_positions[i]).norm())
+        return d
+
+    # the kernels that read the cell and neighbor lists get them as an argument, see particle.list_tables.
+    # Returns the occupancy of the build as a dict, read back from the device in one go
+    def update_neighbors(self):
+        occupancy = self.update_neighbors_kernel(self.ps.tables)
+        return dict(zip(occupancy_names, (int(v) for v in occupancy)))
+
+    @ti.kernel
+    def update_neighbors_kernel(self, lists: ti.template()) -> ti.types.vector(len(occupancy_names), int):
+        if ti.static(neighbor_skin > 0):
+            for i in range(self.ps.num_particles[None]):
+                self.build_positions[i] = self.ps.positions[i]
+
+        self.occupancy[None].cell_overflows = 0
+        self.occupancy[None].neighbor_overflows = 0
+        self.occupancy[None].max_cell_particles = 0
+        self.occupancy[None].max_neighbors = 0
+        self.occupancy[None].num_neighbors = 0
+
         # clear neighbor lookup table
-        for I in ti.grouped(self.ps.grid_num_particles):
-            self.ps.grid_num_particles[I] = 0
-        for I in ti.grouped(self.ps.particle_neighbors):
-            self.ps.particle_neighbors[I] = -1
+        if ti.static(cell_list_mode == 'sparse'):
+            # free all blocks, the update below allocates the occupied ones again
+            # explicit i32 indices, the loop indices are untyped here and deactivate would warn on every compile
+            for i, j, k in lists.grid_blocks:
+                ti.deactivate(lists.grid_blocks, [ti.i32(i), ti.i32(j), ti.i32(k)])
+        else:
+            for I in ti.grouped(lists.grid_num_particles):
+                lists.grid_num_particles[I] = 0
+        if ti.static(neighbor_list_mode == 'dense'):
+            for I in ti.grouped(lists.particle_neighbors):
+                lists.particle_neighbors[I] = -1
 
         # update grid
-        for p_i in self.ps.positions:
-            cell = get_cell(self.ps.positions[p_i])
-            # ti.Vector doesn't seem to support unpacking yet
-            # but we can directly use int Vectors as indices
-            offs = ti.atomic_add(self.ps.grid_num_particles[cell], 1)
-            self.ps.grid2particles[cell, offs] = p_i
+        if ti.static(sorted_cell_list):
+            # counting sort: count per cell, exclusive prefix sum, scatter into one array
+            for p_i in range(self.ps.num_particles[None]):
+                c = get_cell_index(get_cell(self.ps.positions[p_i]))
+                lists.particle_cell[p_i] = c
+                rank = ti.atomic_add(lists.grid_num_particles[c], 1)
+                lists.particle_cell_rank[p_i] = rank
+                ti.atomic_max(self.occupancy[None].max_cell_particles, rank + 1)
+            self.cell_scan.exclusive(lists.grid_num_particles, lists.grid_cell_start)
+            for p_i in range(self.ps.num_particles[None]):
+                c = lists.particle_cell[p_i]
+                lists.grid2particles[lists.grid_cell_start[c] + lists.particle_cell_rank[p_i]] = p_i
+        else:
+            for p_i in range(self.ps.num_particles[None]):
+                cell = get_cell(self.ps.positions[p_i])
+                # ti.Vector doesn't seem to support unpacking yet
+                # but we can directly use int Vectors as indices
+                offs = ti.atomic_add(lists.grid_num_particles[cell], 1)
+                ti.atomic_max(self.occupancy[None].max_cell_particles, offs + 1)
+                if offs < lists.cell_capacity:
+                    lists.grid2particles[cell, offs] = p_i
+                else:
+                    self.occupancy[None].cell_overflows += 1
 
         # find particle neighbors
-        for p_i in self.ps.positions:
-            pos_i = self.ps.positions[p_i]
-            cell = get_cell(pos_i)
-            nb_i = 0
-            for offs in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2),(-1, 2)))):
-                cell_to_check = cell + offs
-                if is_in_grid(cell_to_check):
-                    for j in range(self.ps.grid_num_particles[cell_to_check]):
-                        p_j = self.ps.grid2particles[cell_to_check, j]
-                        if nb_i < max_num_neighbors and p_j != p_i and (pos_i - self.ps.positions[p_j]).norm() < neighbour_radius:
-                            self.ps.particle_neighbors[p_i, nb_i] = p_j
-                            nb_i += 1
-            self.ps.particle_num_neighbors[p_i] = nb_i
+        if ti.static(neighbor_list_mode == 'csr'):
+            # count, exclusive prefix sum into offsets, fill the flat array
+            # the free slots count as empty lists in the prefix sum
+            for p_i in lists.particle_num_neighbors:
+                nb_i = 0
+                if p_i < self.ps.num_particles[None]:
+                    nb_i = self.search_neighbors(lists, p_i, 0, False)
+                lists.particle_num_neighbors[p_i] = nb_i
+                ti.atomic_max(self.occupancy[None].max_neighbors, nb_i)
+                self.occupancy[None].num_neighbors += nb_i
+            self.neighbor_scan.exclusive(lists.particle_num_neighbors, lists.particle_neighbor_offsets)
+            for p_i in range(self.ps.num_particles[None]):
+                # lists that do not fit into the flat array are truncated
+                nb_i = ti.min(lists.particle_num_neighbors[p_i],
+                              lists.neighbor_capacity - lists.particle_neighbor_offsets[p_i])
+                nb_i = ti.max(nb_i, 0)
+                if nb_i < lists.particle_num_neighbors[p_i]:
+                    self.occupancy[None].neighbor_overflows += lists.particle_num_neighbors[p_i] - nb_i
+                lists.particle_num_neighbors[p_i] = nb_i
+                self.search_neighbors(lists, p_i, nb_i, True)
+        else:
+            for p_i in range(self.ps.num_particles[None]):
+                nb_i = self.search_neighbors(lists, p_i, lists.max_neighbors, True)
+                ti.atomic_max(self.occupancy[None].max_neighbors, nb_i)
+                self.occupancy[None].num_neighbors += nb_i
+                if nb_i > lists.max_neighbors:
+                    self.occupancy[None].neighbor_overflows += nb_i - lists.max_neighbors
+                lists.particle_num_neighbors[p_i] = ti.min(nb_i, lists.max_neighbors)
             # if(0.7<self.ps.velocities[p_i][2]<0.8):
             #     self.ps.colors[p_i]=ti.Vector([1,1,1])
             # else:
             #     self.ps.colors[p_i]=ti.Vector([50/255,100/255,200/255])
+        o = self.occupancy[None]
+        return ti.Vector([o.cell_overflows, o.neighbor_overflows, o.max_cell_particles, o.max_neighbors, o.num_neighbors])
+
+    # counts the neighbors of p_i, the first @limit are stored if @store is set
+    @ti.func
+    def search_neighbors(self, lists: ti.template(), p_i, limit, store: ti.template()):
+        pos_i = self.ps.positions[p_i]
+        cell = get_cell(pos_i)
+        search_radius = self.params.field[None].neighbor_search_radius
+        nb_i = 0
+        for offs in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2),(-1, 2)))):
+            cell_to_check = cell + offs
+            if is_in_grid(cell_to_check):
+                begin, end = lists.get_cell_range(cell_to_check)
+                for j in range(begin, end):
+                    p_j = lists.get_cell_particle(cell_to_check, j)
+                    if ti.static(half_neighbor_list):
+                        # the pair is stored with the lower index
+                        if p_j < p_i:
+                            continue
+                    if ti.static(cell_list_mode == 'hash'):
+                        # the bucket is shared with other cells, which may be visited as well
+                        if any(get_cell(self.ps.positions[p_j]) != cell_to_check):
+                            continue
+                    if p_j != p_i and (pos_i - self.ps.positions[p_j]).norm() < search_radius:
+                        if ti.static(store):
+                            if nb_i < limit:
+                                lists.set_neighbor(p_i, nb_i, p_j)
+                        nb_i += 1
+        return nb_i
 
     @ti.kernel
     def epilogue(self):
         # confine to boundary
-        for i in self.ps.positions:
+        for i in range(self.ps.num_particles[None]):
             pos = self.ps.positions[i]
             self.ps.positions[i] = self.ps.confine_position_to_boundary(pos)
         # update velocities
-        for i in self.ps.positions:
-            self.ps.velocities[i] = (self.ps.positions[i] - self.ps.old_positions[i]) / time_delta
+        for i in range(self.ps.num_particles[None]):
+            self.ps.velocities[i] = (self.ps.positions[i] - self.ps.old_positions[i]) / self.dt[None]
         # no vorticity/xsph because we cannot do cross product in 2D...
         
         # add color
@@ -87,110 +401,373 @@ class pbf:
         #     else:
         #         self.ps.colors[p_i]=ti.Vector([50/255,100/255,200/255])
 
-    @ti.kernel
     def apply_vorticity_confinement(self):
+        self.apply_vorticity_confinement_kernel(self.ps.tables)
+
+    @ti.kernel
+    def apply_vorticity_confinement_kernel(self, lists: ti.template()):
+        prm = self.params.field[None]
         # compute omega
-        for p_i in self.ps.positions:
-            pos_i = self.ps.positions[p_i]
-            self.omegas[p_i] = pos_i * 0.0
-            for j in range(self.ps.particle_num_neighbors[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                if p_j < 0:
-                    break
-                pos_ji = pos_i - self.ps.positions[p_j]
-                grad_j = spiky_gradient(pos_ji, h)
-                vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
-                self.omegas[p_i]+= ti.math.cross(vij,grad_j)
+        if ti.static(half_neighbor_list):
+            for p_i in range(self.ps.num_particles[None]):
+                self.omegas[p_i] = ti.Vector([0.0, 0.0, 0.0])
+                self.etas[p_i] = ti.Vector([0.0, 0.0, 0.0])
+            # the term of a pair is the same for both particles, both the velocity difference and the gradient flip
+            ti.loop_config(serialize=self.serial_scatter)
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+                omega_i = ti.Vector([0.0, 0.0, 0.0])
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    grad_j = spiky_gradient(pos_i - self.ps.positions[p_j], prm)
+                    c = ti.math.cross(self.ps.velocities[p_j] - self.ps.velocities[p_i], grad_j)
+                    omega_i += c
+                    ti.atomic_add(self.omegas[p_j], c)
+                ti.atomic_add(self.omegas[p_i], omega_i)
+            ti.loop_config(serialize=self.serial_scatter)
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+                omega_len_i = self.omegas[p_i].norm()
+                eta_i = ti.Vector([0.0, 0.0, 0.0])
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    grad_j = spiky_gradient(pos_i - self.ps.positions[p_j], prm)
+                    eta_i += grad_j * omega_len_i
+                    ti.atomic_sub(self.etas[p_j], grad_j * self.omegas[p_j].norm())
+                ti.atomic_add(self.etas[p_i], eta_i)
+        else:
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+                self.omegas[p_i] = pos_i * 0.0
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    pos_ji = pos_i - self.ps.positions[p_j]
+                    grad_j = spiky_gradient(pos_ji, prm)
+                    vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
+                    self.omegas[p_i]+= ti.math.cross(vij,grad_j)
 
-        for p_i in self.ps.positions:
+        for p_i in range(self.ps.num_particles[None]):
             omega_i = self.omegas[p_i]
             if(omega_i.norm()<epsilon):
                 continue
             eta = self.ps.positions[p_i] * 0.0
-            for j in range(self.ps.particle_num_neighbors[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                if p_j < 0:
-                    break
-                pos_ji = self.ps.positions[p_i] - self.ps.positions[p_j]
-                grad_j = spiky_gradient(pos_ji, h)
-                vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
-                eta+=grad_j * ti.math.length(omega_i)
+            if ti.static(half_neighbor_list):
+                eta = self.etas[p_i]
+            else:
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    pos_ji = self.ps.positions[p_i] - self.ps.positions[p_j]
+                    grad_j = spiky_gradient(pos_ji, prm)
+                    vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
+                    eta+=grad_j * ti.math.length(omega_i)
             if(eta.norm()<epsilon):
                 continue
             N = ti.math.normalize(eta)
-            f = vorticity_confinement_epsilon * ti.math.cross(N,omega_i)
-            self.ps.velocities[p_i]+= f / mass * time_delta
+            f = prm.vorticity_confinement_epsilon * ti.math.cross(N,omega_i)
+            self.ps.velocities[p_i]+= f / prm.mass * self.dt[None]
    
-    @ti.kernel
     def apply_xsph_viscosity(self):
-        for p_i in self.ps.positions:
-            x_vesc = self.ps.positions[p_i] * 0.0
-            pos_i = self.ps.positions[p_i]
-            for j in range(self.ps.particle_num_neighbors[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
-                if p_j < 0:
-                    break
-                vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
-                pos_ji = pos_i - self.ps.positions[p_j]
-                vij *= poly6_value(pos_ji.norm(), h)
-                x_vesc+= vij
-            self.ps.velocities[p_i]+=XSPH_c*x_vesc
+        self.apply_xsph_viscosity_kernel(self.ps.tables)
 
     @ti.kernel
+    def apply_xsph_viscosity_kernel(self, lists: ti.template()):
+        prm = self.params.field[None]
+        if ti.static(half_neighbor_list):
+            for p_i in range(self.ps.num_particles[None]):
+                self.velocity_sums[p_i] = ti.Vector([0.0, 0.0, 0.0])
+            # summed over all pairs before any velocity changes
+            ti.loop_config(serialize=self.serial_scatter)
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+                x_vesc = ti.Vector([0.0, 0.0, 0.0])
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
+                    vij *= poly6_value((pos_i - self.ps.positions[p_j]).norm(), prm)
+                    x_vesc += vij
+                    ti.atomic_sub(self.velocity_sums[p_j], vij)
+                ti.atomic_add(self.velocity_sums[p_i], x_vesc)
+            for p_i in range(self.ps.num_particles[None]):
+                self.ps.velocities[p_i] += prm.XSPH_c * self.velocity_sums[p_i]
+        else:
+            for p_i in range(self.ps.num_particles[None]):
+                x_vesc = self.ps.positions[p_i] * 0.0
+                pos_i = self.ps.positions[p_i]
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    vij = self.ps.velocities[p_j] - self.ps.velocities[p_i]
+                    pos_ji = pos_i - self.ps.positions[p_j]
+                    vij *= poly6_value(pos_ji.norm(), prm)
+                    x_vesc+= vij
+                self.ps.velocities[p_i]+=prm.XSPH_c*x_vesc
+
+    # @w: poly6 value of the pair
+    @ti.func
+    def compute_scorr(self, w, prm):
+        # Eq (13)
+        x = w / prm.scorr_denominator
+        # pow(x, 4)
+        x = ti.pow(x,4)
+        return (prm.corrK) * x
+
+    # spiky gradient and poly6 value of p_i and its j-th neighbor, kept for the delta loop with cache_pair_kernels
+    @ti.func
+    def evaluate_pair(self, lists: ti.template(), p_i, j, pos_ji, prm):
+        grad_j = ti.Vector([0.0, 0.0, 0.0])
+        w = 0.0
+        if ti.static(cache_pair_kernels):
+            r_len = pos_ji.norm()
+            grad_j = spiky_gradient_norm(pos_ji, r_len, prm)
+            w = poly6_value(r_len, prm)
+            # the positions stay the same until the deltas are applied, the delta loop reads them back
+            lists.set_pair_kernels(p_i, j, grad_j, w)
+        else:
+            grad_j = spiky_gradient(pos_ji, prm)
+            w = poly6_value(pos_ji.norm(), prm)
+        return grad_j, w
+
+    # the same values in the delta loop
+    @ti.func
+    def reevaluate_pair(self, lists: ti.template(), p_i, j, p_j, pos_i, prm):
+        grad_j = ti.Vector([0.0, 0.0, 0.0])
+        w = 0.0
+        if ti.static(cache_pair_kernels):
+            grad_j, w = lists.get_pair_kernels(p_i, j)
+        else:
+            pos_ji = pos_i - self.ps.positions[p_j]
+            grad_j = spiky_gradient(pos_ji, prm)
+            w = poly6_value(pos_ji.norm(), prm)
+        return grad_j, w
+
+    # Eq (1), (8) - (11) from the sums over the neighbors of p_i
+    @ti.func
+    def set_lambda(self, p_i, density_constraint, grad_i, sum_gradient_sqr, prm):
+        # Eq(1)
+        density_constraint = (prm.mass * density_constraint / prm.rho0) - 1.0
+        if ti.static(solver_tolerance > 0):
+            # only compression counts, the constraint is not enforced for sparse neighborhoods
+            if ti.static(solver_error_norm == 'max'):
+                ti.atomic_max(self.density_error[None], ti.max(density_constraint, 0.0))
+            else:
+                self.density_error[None] += ti.max(density_constraint, 0.0) / self.ps.num_particles[None]
+
+        sum_gradient_sqr += grad_i.dot(grad_i)
+        self.ps.lambdas[p_i] = (-density_constraint) / (sum_gradient_sqr + prm.lambda_epsilon)
+
     def PBF_solver(self):
-        # compute lambdas
-        # Eq (8) ~ (11)
-        for p_i in self.ps.positions:
-            pos_i = self.ps.positions[p_i]
+        self.PBF_solver_kernel(self.ps.tables)
+
+    @ti.kernel
+    def PBF_solver_kernel(self, lists: ti.template()):
+        self.solver_iteration(lists)
+
+    # all pdf_num_iters iterations in one launch; the loops of every iteration
+    # stay separate parallel tasks, so the syncs between them are kept
+    def PBF_solver_fused(self):
+        self.PBF_solver_fused_kernel(self.ps.tables)
+
+    @ti.kernel
+    def PBF_solver_fused_kernel(self, lists: ti.template()):
+        for _ in ti.static(range(pdf_num_iters)):
+            self.solver_iteration(lists)
+
+    @ti.func
+    def solver_iteration(self, lists: ti.template()):
+        prm = self.params.field[None]
+        if ti.static(solver_tolerance > 0):
+            self.density_error[None] = 0.0
+        if ti.static(half_neighbor_list):
+            self.solver_iteration_half(lists, prm)
+        else:
+            # compute lambdas
+            # Eq (8) ~ (11)
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+
+                grad_i = ti.Vector([0.0, 0.0, 0.0])
+                sum_gradient_sqr = 0.0
+                density_constraint = 0.0
+
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    pos_ji = pos_i - self.ps.positions[p_j]
+                    grad_j, w = self.evaluate_pair(lists, p_i, j, pos_ji, prm)
+                    grad_i += grad_j
+                    sum_gradient_sqr += grad_j.dot(grad_j)
+                    # Eq(2)
+                    density_constraint += w
+
+                self.set_lambda(p_i, density_constraint, grad_i, sum_gradient_sqr, prm)
 
+            # compute position deltas
+            # Eq(12), (14)
+            for p_i in range(self.ps.num_particles[None]):
+                pos_i = self.ps.positions[p_i]
+                lambda_i = self.ps.lambdas[p_i]
+
+                pos_delta_i = ti.Vector([0.0, 0.0, 0.0])
+                for j in range(lists.particle_num_neighbors[p_i]):
+                    p_j = lists.get_neighbor(p_i, j)
+                    if p_j < 0:
+                        break
+                    lambda_j = self.ps.lambdas[p_j]
+                    grad_j, w = self.reevaluate_pair(lists, p_i, j, p_j, pos_i, prm)
+                    scorr_ij = self.compute_scorr(w, prm)
+                    pos_delta_i += (lambda_i + lambda_j + scorr_ij) * grad_j
+
+                pos_delta_i /= prm.rho0
+                self.ps.position_deltas[p_i] = pos_delta_i
+
+        # apply position deltas
+        for i in range(self.ps.num_particles[None]):
+            self.ps.positions[i] += self.ps.position_deltas[i]
+
+    # same sums over the half lists: a pair is evaluated once and added to both particles,
+    # seen from p_j the gradient is -grad_j and the position delta term flips its sign
+    @ti.func
+    def solver_iteration_half(self, lists: ti.template(), prm):
+        for p_i in range(self.ps.num_particles[None]):
+            self.density_sums[p_i] = 0.0
+            self.gradient_sums[p_i] = ti.Vector([0.0, 0.0, 0.0])
+            self.gradient_sqr_sums[p_i] = 0.0
+            self.ps.position_deltas[p_i] = ti.Vector([0.0, 0.0, 0.0])
+        ti.loop_config(serialize=self.serial_scatter)
+        for p_i in range(self.ps.num_particles[None]):
+            pos_i = self.ps.positions[p_i]
             grad_i = ti.Vector([0.0, 0.0, 0.0])
             sum_gradient_sqr = 0.0
             density_constraint = 0.0
-
-            for j in range(self.ps.particle_num_neighbors[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
+            for j in range(lists.particle_num_neighbors[p_i]):
+                p_j = lists.get_neighbor(p_i, j)
                 if p_j < 0:
                     break
                 pos_ji = pos_i - self.ps.positions[p_j]
-                grad_j = spiky_gradient(pos_ji, h)
+                grad_j, w = self.evaluate_pair(lists, p_i, j, pos_ji, prm)
+                grad_sqr = grad_j.dot(grad_j)
                 grad_i += grad_j
-                sum_gradient_sqr += grad_j.dot(grad_j)
-                # Eq(2)
-                density_constraint += poly6_value(pos_ji.norm(), h)
+                sum_gradient_sqr += grad_sqr
+                density_constraint += w
+                ti.atomic_sub(self.gradient_sums[p_j], grad_j)
+                ti.atomic_add(self.gradient_sqr_sums[p_j], grad_sqr)
+                ti.atomic_add(self.density_sums[p_j], w)
+            ti.atomic_add(self.gradient_sums[p_i], grad_i)
+            ti.atomic_add(self.gradient_sqr_sums[p_i], sum_gradient_sqr)
+            ti.atomic_add(self.density_sums[p_i], density_constraint)
+        for p_i in range(self.ps.num_particles[None]):
+            self.set_lambda(p_i, self.density_sums[p_i], self.gradient_sums[p_i], self.gradient_sqr_sums[p_i], prm)
 
-            # Eq(1)
-            density_constraint = (mass * density_constraint / rho0) - 1.0
-
-            sum_gradient_sqr += grad_i.dot(grad_i)
-            self.ps.lambdas[p_i] = (-density_constraint) / (sum_gradient_sqr + lambda_epsilon)
-        
-        # compute position deltas
-        # Eq(12), (14)
-        for p_i in self.ps.positions:
+        ti.loop_config(serialize=self.serial_scatter)
+        for p_i in range(self.ps.num_particles[None]):
             pos_i = self.ps.positions[p_i]
             lambda_i = self.ps.lambdas[p_i]
-
             pos_delta_i = ti.Vector([0.0, 0.0, 0.0])
-            for j in range(self.ps.particle_num_neighbors[p_i]):
-                p_j = self.ps.particle_neighbors[p_i, j]
+            for j in range(lists.particle_num_neighbors[p_i]):
+                p_j = lists.get_neighbor(p_i, j)
                 if p_j < 0:
                     break
-                lambda_j = self.ps.lambdas[p_j]
-                pos_ji = pos_i - self.ps.positions[p_j]
-                scorr_ij = compute_scorr(pos_ji)
-                pos_delta_i += (lambda_i + lambda_j + scorr_ij) * spiky_gradient(pos_ji, h)
+                grad_j, w = self.reevaluate_pair(lists, p_i, j, p_j, pos_i, prm)
+                delta = (lambda_i + self.ps.lambdas[p_j] + self.compute_scorr(w, prm)) * grad_j
+                pos_delta_i += delta
+                ti.atomic_sub(self.ps.position_deltas[p_j], delta)
+            ti.atomic_add(self.ps.position_deltas[p_i], pos_delta_i)
+        for p_i in range(self.ps.num_particles[None]):
+            self.ps.position_deltas[p_i] /= prm.rho0
 
-            pos_delta_i /= rho0
-            self.ps.position_deltas[p_i] = pos_delta_i
-        
-        # apply position deltas
-        for i in self.ps.positions:
-            self.ps.positions[i] += self.ps.position_deltas[i]
+    # the error is measured while the lambdas are computed, so it belongs to the positions an iteration starts from.
+    # Reading it back waits for the iteration to finish.
+    def solve_to_tolerance(self):
+        for it in range(1, max_solver_iters + 1):
+            self.PBF_solver()
+            self.last_density_error = self.density_error[None]
+            if it >= min_solver_iters and self.last_density_error <= solver_tolerance:
+                break
+        self.solver_iters = it
 
+    # advances the simulation by time_delta
     def run_PBF(self):
-        self.prologue()
-        for _ in range(pdf_num_iters):
-            self.PBF_solver()
-        self.epilogue()
-        self.apply_vorticity_confinement()
-        self.apply_xsph_viscosity()
\ No newline at end of file
+        record = self.telemetry is not None and self.num_frames % telemetry_interval == 0
+        if record:
+            self.timer.enabled = True
+            self.timer.reset()
+            ti.sync()
+            start = time.perf_counter()
+        self.advance()
+        if record:
+            ti.sync()
+            wall_time = time.perf_counter() - start
+            with self.timer.phase('telemetry'):
+                self.write_telemetry(wall_time)
+            self.timer.enabled = False
+        self.num_frames += 1
+
+    def advance(self):
+        if adaptive_timestep:
+            # the speed at the end of the frame is bounded by the current one plus gravity
+            v_max = self.max_speed() + np.linalg.norm(self.params.get('gravity')) * time_delta
+            self.num_substeps = min(max(math.ceil(time_delta * v_max / (cfl_number * self.params.get('h'))), 1), max_substeps)
+            self.dt[None] = time_delta / self.num_substeps
+        for _ in range(self.num_substeps):
+            with self.timer.phase('step'):
+                self.step()
+
+    def step(self):
+        if reorder_interval > 0 and self.num_steps % reorder_interval == 0:
+            with self.timer.phase('reorder'):
+                self.ps.reorder_particles()
+            # indices changed, the neighbor lists have to be rebuilt
+            self.neighbors_valid = False
+        self.num_steps += 1
+        with self.timer.phase('prologue'):
+            self.prologue()
+        with self.timer.phase('solver'):
+            if solver_tolerance > 0:
+                self.solve_to_tolerance()
+            elif fused_solver:
+                self.PBF_solver_fused()
+                self.solver_iters = pdf_num_iters
+            else:
+                for _ in range(pdf_num_iters):
+                    self.PBF_solver()
+                    if self.sync_ghosts is not None:
+                        self.sync_ghosts()
+                self.solver_iters = pdf_num_iters
+        self.total_solver_iters += self.solver_iters
+        with self.timer.phase('epilogue'):
+            self.epilogue()
+            self.apply_vorticity_confinement()
+            self.apply_xsph_viscosity()
+
+    # one record of the frame that just ended, summed over its substeps
+    def write_telemetry(self, wall_time):
+        self.reduce_metrics()
+        metrics = self.metrics[None]
+        self.telemetry.write({
+            'frame': self.num_frames,
+            'time': (self.num_frames + 1) * time_delta,
+            'steps': self.num_steps,
+            'substeps': self.num_substeps,
+            'dt': self.dt[None],
+            'wall_time': wall_time,
+            'phases': {name: self.timer.times.get(name, 0.0) for name in step_phases},
+            'solver_iters': self.solver_iters,
+            'max_density_error': metrics.max_density_error,
+            'mean_density_error': metrics.mean_density_error,
+            'max_velocity': metrics.max_velocity,
+            'num_particles': self.ps.num_particles[None],
+            'board_state': self.ps.board_states[None],
+            'neighbor_histogram': self.neighbor_histogram.to_numpy().tolist(),
+        })
\ No newline at end of file
@@ -0,0 +1,27 @@
+# exclusive prefix sum over a 1D int field.
+# Blocks of `block_size` elements are scanned in parallel, then the block sums are scanned serially.
+import taichi as ti
+
+
+@ti.data_oriented
+class prefix_sum:
+    def __init__(self, n, block_size=256):
+        self.n = n
+        self.block_size = block_size
+        self.num_blocks = (n + block_size - 1) // block_size
+        self.block_sums = ti.field(int, self.num_blocks)
+
+    # dst[i] = src[0] + ... + src[i-1], call it from the outermost scope of a kernel
+    @ti.func
+    def exclusive(self, src, dst):
+        for b in range(self.num_blocks):
+            s = 0
+            for i in range(b * self.block_size, ti.min((b + 1) * self.block_size, self.n)):
+                dst[i] = s
+                s += src[i]
+            self.block_sums[b] = s
+        ti.loop_config(serialize=True)
+        for b in range(1, self.num_blocks):
+            self.block_sums[b] += self.block_sums[b - 1]
+        for i in range(self.block_size, self.n):
+            dst[i] += self.block_sums[i // self.block_size - 1]
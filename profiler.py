@@ -0,0 +1,105 @@
+# Profiling mode of the runners (--profile). The phases of pbf.step and the export are timed as scopes, the
+# kernel profiler of taichi times every offloaded task (one parallel loop of a kernel). Writes a Chrome / Perfetto
+# trace (chrome://tracing, ui.perfetto.dev) and prints the scopes and tasks sorted by total time.
+# The kernel profiler only reports durations: the tasks of a scope are laid out back to back from its start.
+import json
+import re
+import time
+import taichi as ti
+
+# taichi names the tasks <kernel>_c<id>_<instance>_kernel_<task>_<loop type>
+task_name_pattern = re.compile(r'^(.*)_c\d+_\d+_kernel_(\d+)_(\w+?)$')
+
+
+# The public profiler API (ti.profiler.query_kernel_profiler_info) only returns aggregates for a kernel name that is
+# already known, the single task records come from the program of taichi 1.7.x, the same call that
+# ti.profiler.print_kernel_profiler_info uses. Fails up front instead of in the middle of a run when that changed.
+def check_kernel_records():
+    prog = ti.lang.impl.get_runtime().prog
+    if not callable(getattr(prog, 'get_kernel_profiler_records', None)):
+        version = '.'.join(map(str, ti.__version__))
+        raise RuntimeError(f"the kernel task records cannot be read with taichi {version} (written for 1.7.x), "
+                           f"run --profile without the kernel profiler")
+
+
+# (name, duration in ms) of the tasks that ran since the last ti.profiler.clear_kernel_profiler_info
+def kernel_records():
+    return [(record.name, record.kernel_time) for record in ti.lang.impl.get_runtime().prog.get_kernel_profiler_records()]
+
+
+def task_label(name):
+    match = task_name_pattern.match(name)
+    if match is None:
+        return name
+    kernel, task, loop = match.groups()
+    return f"{kernel} #{task} {loop}"
+
+
+class trace_profiler:
+    # needs ti.init(kernel_profiler=True) for the tasks, the scopes are recorded either way
+    def __init__(self):
+        self.kernels = ti.lang.impl.current_cfg().kernel_profiler
+        if self.kernels:
+            check_kernel_records()
+        self.reset()
+
+    # drops everything recorded so far, e.g. the warm-up steps with the JIT compilation
+    def reset(self):
+        if self.kernels:
+            ti.profiler.clear_kernel_profiler_info()
+        self.origin = time.perf_counter()
+        self.events = []
+        # name -> [calls, total, min, max] in seconds
+        self.scope_stats = {}
+        self.task_stats = {}
+        # end of the last laid out task
+        self.cursor = 0.0
+
+    # called by phase_timer at the end of a scope, after a sync
+    def add_scope(self, name, start, end):
+        start -= self.origin
+        end -= self.origin
+        self.events.append({'name': name, 'cat': 'scope', 'ph': 'X', 'pid': 0, 'tid': 0,
+                            'ts': start * 1e6, 'dur': (end - start) * 1e6})
+        accumulate(self.scope_stats, name, end - start)
+        if self.kernels:
+            # the tasks that finished since the last scope ended were launched within this one
+            self.cursor = max(self.cursor, start)
+            for name, kernel_time in kernel_records():
+                label = task_label(name)
+                duration = kernel_time * 1e-3
+                self.events.append({'name': label, 'cat': 'task', 'ph': 'X', 'pid': 0, 'tid': 1,
+                                    'ts': self.cursor * 1e6, 'dur': duration * 1e6, 'args': {'scope': name}})
+                accumulate(self.task_stats, label, duration)
+                self.cursor += duration
+            ti.profiler.clear_kernel_profiler_info()
+
+    def write_trace(self, path):
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': name}}
+                 for tid, name in [(0, 'scopes'), (1, 'kernel tasks')]]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def print_summary(self):
+        wall = max((e['ts'] + e['dur'] for e in self.events), default=0.0) * 1e-6
+        print_table('scope', self.scope_stats, wall)
+        if self.kernels:
+            print_table('kernel task', self.task_stats, sum(s[1] for s in self.task_stats.values()))
+
+
+def accumulate(stats, name, duration):
+    s = stats.setdefault(name, [0, 0.0, duration, duration])
+    s[0] += 1
+    s[1] += duration
+    s[2] = min(s[2], duration)
+    s[3] = max(s[3], duration)
+
+
+# rows sorted by total time, share relative to @reference seconds
+def print_table(title, stats, reference):
+    width = max([len(title)] + [len(name) for name in stats])
+    print(f"{title:<{width}}  {'calls':>7}  {'total ms':>10}  {'mean ms':>9}  {'min ms':>9}  {'max ms':>9}  {'share':>6}")
+    for name, (calls, total, t_min, t_max) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        share = total / reference * 100 if reference > 0 else 0.0
+        print(f"{name:<{width}}  {calls:7d}  {total * 1e3:10.2f}  {total / calls * 1e3:9.3f}  "
+              f"{t_min * 1e3:9.3f}  {t_max * 1e3:9.3f}  {share:5.1f}%")
@@ -52,6 +52,15 @@ max_num_neighbors = 100
 
 rigid_body_path = "./Dragon_50k.obj"
 num_particles_obj = 0
+rigid_scale = 15.0
+rigid_displacement = [25, 0, 25]
+# 'volume' (filled voxels) or 'surface' (shell voxels only)
+rigid_sampling_mode = 'volume'
+# sampled rigid particles are cached here, None disables the cache
+rigid_cache_dir = './cache'
+# 'particles': the rigid particles take part in the neighbor search and the solver
+# 'sdf': the rigid body is static, baked into a signed distance field and left out of the solver loops
+rigid_boundary = 'particles'
 
 # PBF parameters
 # kernel radius
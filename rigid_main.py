@@ -1,7 +1,7 @@
 # The GUI of our project. Containing the input and output setup.
 import taichi as ti
 from rigid_config import *
-from rigid_particle import particle_system
+from rigid_particle import particle_system, Material
 from rigid_pbf import pbf
 
 ti.init(arch=ti.gpu)  # 确定后端
@@ -85,15 +85,13 @@ while window.running:
     # 示范用例
     # 用per_vertex_color给颜色数组
 
-    fluid_positions = ti.Vector.field(dim, dtype=float, shape=ps.n_fluid_particles)
-    rigid_positions = ti.Vector.field(dim, dtype=float, shape=ps.n_rigid_particles)
-
-    # 将 self.positions 分割成两个数组
-    fluid_positions.from_numpy(ps.positions.to_numpy()[:ps.n_fluid_particles])
-    rigid_positions.from_numpy(ps.positions.to_numpy()[ps.n_fluid_particles:ps.n_total_particles])
-    
-    scene.particles(fluid_positions, per_vertex_color=ps.colors, radius = particle_radius)
-    scene.particles(rigid_positions, color = (0.68, 0.26, 0.19), radius = particle_radius*1.5)
+    # draw each material straight from the particle fields, no per-frame copies
+    fluid_offset, fluid_count = ps.material_ranges[Material.Fluid]
+    rigid_offset, rigid_count = ps.material_ranges[Material.Rigid]
+    scene.particles(ps.positions, per_vertex_color=ps.colors, radius = particle_radius,
+                    index_offset=fluid_offset, index_count=fluid_count)
+    scene.particles(ps.positions, color = (0.68, 0.26, 0.19), radius = particle_radius*1.5,
+                    index_offset=rigid_offset, index_count=rigid_count)
     
     # draw water-tank
     scene.lines(tank_vertex, width=3.0, indices=tank_edge, color=(0, 0, 0))
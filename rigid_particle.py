@@ -2,7 +2,7 @@
 import taichi as ti
 from rigid_config import *
 import numpy as np
-import trimesh as tm
+from rigid_sampling import sample_mesh, distance_field
 
 @ti.data_oriented
 class Material:
@@ -21,8 +21,8 @@ class particle_system():
         self.n_rigid_particles = 0
         self.n_total_particles = 1
         self.velocities = ti.Vector.field(dim, float)
-        self.scale_factor=15.0
-        self.displacement_factor=[10,0,10]
+        self.scale_factor = rigid_scale
+        self.displacement_factor = rigid_displacement
         
         self.colors = ti.Vector.field(dim, float)
         
@@ -37,12 +37,11 @@ class particle_system():
             self.n_fluid_particles *= len(np.arange(fluid_blocks_1_start[i], fluid_blocks_1_end[i], delta))
 
         #rigid
-        mesh = tm.load(rigid_body_path)
-        mesh.vertices *= self.scale_factor
-        mesh.vertices += np.array(self.displacement_factor)
-        voxelized_mesh = mesh.voxelized(pitch=2*particle_radius).fill()
-        voxelized_points_np = voxelized_mesh.points.astype(np.float32)
-        self.n_rigid_particles = voxelized_points_np.shape[0]
+        # sampled once here, add_rigid_body writes the same points into the field
+        self.rigid_points = sample_mesh(rigid_body_path, self.scale_factor, self.displacement_factor,
+                                        pitch=2*particle_radius, mode=rigid_sampling_mode,
+                                        cache_dir=rigid_cache_dir)
+        self.n_rigid_particles = self.rigid_points.shape[0]
 
 
         # self.voxelized_points = ti.Vector.field(dim, ti.f32, num_particles_obj)
@@ -50,6 +49,11 @@ class particle_system():
 
 
         self.n_total_particles = self.n_fluid_particles + self.n_rigid_particles
+        # particles of a material are contiguous in the particle fields: (first index, count)
+        self.material_ranges = {
+            Material.Fluid: (0, self.n_fluid_particles),
+            Material.Rigid: (self.n_fluid_particles, self.n_rigid_particles),
+        }
 
         # self.board_states = ti.Vector.field(dim, float)
         ti.root.dense(ti.i, self.n_total_particles).place(self.old_positions, self.positions, self.velocities, self.colors)
@@ -60,9 +64,16 @@ class particle_system():
         nb_node.place(self.particle_num_neighbors)
         nb_node.dense(ti.j, max_num_neighbors).place(self.particle_neighbors)
         ti.root.dense(ti.i, self.n_total_particles).place(self.lambdas, self.position_deltas)
-        print(self.n_rigid_particles)
-        print(self.n_fluid_particles)
-        print(self.n_total_particles)
+
+        # particles handled by the neighbor search and the solver, a static rigid body is not one of them
+        self.n_solver_particles = self.n_total_particles
+        if rigid_boundary == 'sdf':
+            self.n_solver_particles = self.n_fluid_particles
+            # covers the kernel radius around the body, outside of it the body has no influence
+            self.rigid_sdf_dx = 2*particle_radius
+            origin, self.rigid_sdf_np = distance_field(self.rigid_points, self.rigid_sdf_dx, margin=h)
+            self.rigid_sdf_origin = [float(v) for v in origin]
+            self.rigid_sdf = ti.field(float, self.rigid_sdf_np.shape)
 
         # ti.root.place(self.board_states)    
     
@@ -86,27 +97,16 @@ class particle_system():
             # self.colors[i] = ti.Vector([0,0,1])
         # self.board_states = ti.Vector([boundary[0] - epsilon, -0.0, 0.0])
     
-    def add_rigid_body(self, scale_factor=15.0, displacement_factor=[25,0,25]):
-        mesh = tm.load(rigid_body_path)
-        mesh.vertices *= scale_factor
-        mesh.vertices += np.array(displacement_factor)
-        voxelized_mesh = mesh.voxelized(pitch=2*particle_radius).fill()
-        voxelized_points_np = voxelized_mesh.points.astype(np.float32)
-        print(voxelized_points_np)
+    def add_rigid_body(self):
+        self.set_rigid_positions(self.rigid_points)
+        if rigid_boundary == 'sdf':
+            self.rigid_sdf.from_numpy(self.rigid_sdf_np)
+
+    @ti.kernel
+    def set_rigid_positions(self, points: ti.types.ndarray()):
         for i in range(self.n_rigid_particles):
-            posx = mesh.vertices[i][0]
-            posy = mesh.vertices[i][1]
-            posz = mesh.vertices[i][2]
-            self.positions[i + self.n_fluid_particles] = ti.Vector([posx, posy, posz])
-
-        # voxelized_mesh = mesh.voxelized(pitch=2*particle_radius).fill()
-        # voxelized_points_np = voxelized_mesh.points.astype(np.float32)
-        # # voxelized_points_np *= scale_factor  # Scale the positions
-        # num_particles_obj = voxelized_points_np.shape[0]
-        
-        # self.voxelized_points = ti.Vector.field(dim, ti.f32, num_particles_obj)
-        # self.voxelized_points.from_numpy(voxelized_points_np)
-        
+            for c in ti.static(range(dim)):
+                self.positions[i + self.n_fluid_particles][c] = points[i, c]
 
     # function handling boundary conditions
     @ti.func
@@ -122,4 +122,38 @@ class particle_system():
                 p[i] = bmax[i] - epsilon * ti.random()
         return p
 
+    # trilinear interpolation of the rigid body distance field, h outside of the field
+    @ti.func
+    def rigid_distance(self, p):
+        x = (p - ti.Vector(self.rigid_sdf_origin)) / self.rigid_sdf_dx
+        base = ti.floor(x, int)
+        d = h
+        if all(base >= 0) and all(base < ti.Vector(self.rigid_sdf.shape) - 1):
+            f = x - base
+            d = 0.0
+            for o in ti.static(ti.ndrange(2, 2, 2)):
+                w = 1.0
+                for c in ti.static(range(dim)):
+                    w *= f[c] if ti.static(o[c]) else 1.0 - f[c]
+                d += w * self.rigid_sdf[base + ti.Vector(o)]
+        return d
+
+    # outward normal of the rigid body surface, central differences of the distance field
+    @ti.func
+    def rigid_normal(self, p):
+        n = ti.Vector([0.0, 0.0, 0.0])
+        for c in ti.static(range(dim)):
+            e = ti.Vector([0.0, 0.0, 0.0])
+            e[c] = 0.5 * self.rigid_sdf_dx
+            n[c] = self.rigid_distance(p + e) - self.rigid_distance(p - e)
+        return n.normalized(1e-12)
+
+    # pushes a particle that overlaps the rigid body back onto its surface
+    @ti.func
+    def confine_position_to_rigid(self, p):
+        d = self.rigid_distance(p)
+        if d < particle_radius:
+            p += (particle_radius - d) * self.rigid_normal(p)
+        return p
+
     
\ No newline at end of file
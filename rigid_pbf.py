@@ -12,6 +12,34 @@ from rigid_config import *
 class pbf:
     def __init__(self, ps):
         self.ps = ps
+        if rigid_boundary == 'sdf':
+            # density, gradient sum along the normal, squared gradient sum and scorr gradient sum along the normal
+            # of a half space filled with rigid particles, by the distance to its surface in [0, h]
+            self.boundary_table_size = 64
+            self.boundary_table = ti.Vector.field(4, float, self.boundary_table_size)
+            self.compute_boundary_table()
+
+    @ti.kernel
+    def compute_boundary_table(self):
+        r = ti.static(int(math.ceil(h / particle_diameter)))
+        for t in range(self.boundary_table_size):
+            d = t * h / (self.boundary_table_size - 1)
+            terms = ti.Vector([0.0, 0.0, 0.0, 0.0])
+            # rigid particles sit half a spacing below the surface, the normal is +z
+            for i, j, k in ti.ndrange((-r, r + 1), (-r, r + 1), (0, r + 1)):
+                pos_ji = ti.Vector([i, j, d / particle_diameter + k + 0.5]) * particle_diameter
+                grad_j = spiky_gradient(pos_ji, h)
+                terms += ti.Vector([poly6_value(pos_ji.norm(), h), grad_j[2], grad_j.dot(grad_j),
+                                    compute_scorr(pos_ji) * grad_j[2]])
+            self.boundary_table[t] = terms
+
+    # boundary table entry at distance @d from the rigid surface
+    @ti.func
+    def boundary_terms(self, d):
+        x = ti.min(ti.max(d, 0.0), h) / h * (self.boundary_table_size - 1)
+        t = ti.min(int(x), self.boundary_table_size - 2)
+        f = x - t
+        return (1.0 - f) * self.boundary_table[t] + f * self.boundary_table[t + 1]
         
     @ti.kernel
     def prologue(self):
@@ -34,6 +62,8 @@ class pbf:
                 pos, vel = self.ps.positions[i], self.ps.velocities[i]
                 vel += gravity * time_delta
                 pos += vel * time_delta
+                if ti.static(rigid_boundary == 'sdf'):
+                    pos = self.ps.confine_position_to_rigid(pos)
                 self.ps.positions[i] = self.ps.confine_position_to_boundary(pos)    # check whether hit boundary
 
         # clear neighbor lookup table
@@ -43,7 +73,7 @@ class pbf:
             self.ps.particle_neighbors[I] = -1
 
         # update grid
-        for p_i in self.ps.positions:
+        for p_i in range(self.ps.n_solver_particles):
             cell = get_cell(self.ps.positions[p_i])
             # ti.Vector doesn't seem to support unpacking yet
             # but we can directly use int Vectors as indices
@@ -51,7 +81,7 @@ class pbf:
             self.ps.grid2particles[cell, offs] = p_i
 
         # find particle neighbors
-        for p_i in self.ps.positions:
+        for p_i in range(self.ps.n_solver_particles):
             pos_i = self.ps.positions[p_i]
             cell = get_cell(pos_i)
             nb_i = 0
@@ -71,6 +101,8 @@ class pbf:
         for i in self.ps.positions:
             if (i<self.ps.n_fluid_particles):
                 pos = self.ps.positions[i]
+                if ti.static(rigid_boundary == 'sdf'):
+                    pos = self.ps.confine_position_to_rigid(pos)
                 self.ps.positions[i] = self.ps.confine_position_to_boundary(pos)
         # update velocities
         for i in self.ps.positions:
@@ -82,7 +114,7 @@ class pbf:
     def PBF_solver(self):
         # compute lambdas
         # Eq (8) ~ (11)
-        for p_i in self.ps.positions:
+        for p_i in range(self.ps.n_solver_particles):
             pos_i = self.ps.positions[p_i]
 
             grad_i = ti.Vector([0.0, 0.0, 0.0])
@@ -113,6 +145,15 @@ class pbf:
                     # Eq(2)
                     density_constraint += poly6_value(pos_ji.norm(), h)
 
+            if ti.static(rigid_boundary == 'sdf'):
+                # the static rigid body, its particles summed up in the boundary table
+                d = self.ps.rigid_distance(pos_i)
+                if d < h:
+                    b = self.boundary_terms(d)
+                    density_constraint += b[0]
+                    grad_i += b[1] * self.ps.rigid_normal(pos_i)
+                    sum_gradient_sqr += b[2]
+
             # Eq(1)
             density_constraint = (mass * density_constraint / rho0) - 1.0
 
@@ -121,7 +162,7 @@ class pbf:
         
         # compute position deltas
         # Eq(12), (14)
-        for p_i in self.ps.positions:
+        for p_i in range(self.ps.n_solver_particles):
             pos_i = self.ps.positions[p_i]
             lambda_i = self.ps.lambdas[p_i]
 
@@ -134,6 +175,13 @@ class pbf:
                 pos_ji = pos_i - self.ps.positions[p_j]
                 scorr_ij = compute_scorr(pos_ji)
                 pos_delta_i += (lambda_i + lambda_j + scorr_ij) * spiky_gradient(pos_ji, h)
+
+            if ti.static(rigid_boundary == 'sdf'):
+                # the rigid particles have no lambda of their own
+                d = self.ps.rigid_distance(pos_i)
+                if d < h:
+                    b = self.boundary_terms(d)
+                    pos_delta_i += (lambda_i * b[1] + b[3]) * self.ps.rigid_normal(pos_i)
                 
             pos_delta_i /= rho0
             self.ps.position_deltas[p_i] = pos_delta_i
@@ -143,6 +191,8 @@ class pbf:
         for i in self.ps.positions:
             if (i<self.ps.n_fluid_particles):
                 self.ps.positions[i] += self.ps.position_deltas[i]
+                if ti.static(rigid_boundary == 'sdf'):
+                    self.ps.positions[i] = self.ps.confine_position_to_rigid(self.ps.positions[i])
 
     def run_PBF(self):
         self.prologue()
@@ -0,0 +1,102 @@
+# Mesh to particle sampling for rigid bodies.
+# The sampled particle positions are cached on disk, keyed by the mesh content, scale, displacement, pitch and mode,
+# so only the first launch pays for loading and voxelizing the mesh.
+import hashlib
+import json
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import trimesh as tm
+from scipy import ndimage
+
+# bump when the sampling itself changes, old cache entries are then ignored
+cache_version = 1
+# faces per chunk of the parallel voxelization
+chunk_faces = 8192
+
+
+def cache_key(mesh_path, scale, displacement, pitch, mode):
+    sha = hashlib.sha256()
+    with open(mesh_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    params = [cache_version, float(scale), [float(d) for d in displacement], float(pitch), mode]
+    sha.update(json.dumps(params).encode())
+    return sha.hexdigest()
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, f"rigid_{key[:24]}.npy")
+
+
+# voxel indices hit by the surface of the faces, same as trimesh.voxel.creation.voxelize_subdivide:
+# faces are subdivided until every edge is shorter than pitch / 2 and the vertices are rounded to the grid
+def surface_voxels(vertices, faces, pitch):
+    v, _ = tm.remesh.subdivide_to_size(vertices, faces, max_edge=pitch / 2.0, max_iter=10)
+    return np.unique(np.round(v / pitch).astype(np.int64), axis=0)
+
+
+# @mode: 'volume' fills the inside of the mesh, 'surface' keeps the shell only
+def voxelize(mesh, pitch, mode='volume', workers=0):
+    workers = workers or os.cpu_count() or 1
+    faces = mesh.faces
+    chunks = [faces[i:i + chunk_faces] for i in range(0, len(faces), chunk_faces)]
+    # fork only: spawned workers would re-run the unguarded main script (rigid_main.py opens the window at import)
+    if workers > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # the faces are independent of each other, each worker voxelizes a chunk of them
+        ctx = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=ctx) as executor:
+            parts = list(executor.map(surface_voxels, [mesh.vertices] * len(chunks), chunks,
+                                      [pitch] * len(chunks)))
+    else:
+        parts = [surface_voxels(mesh.vertices, chunk, pitch) for chunk in chunks]
+    indices = np.unique(np.concatenate(parts), axis=0)
+
+    origin = indices.min(axis=0)
+    grid = tm.voxel.VoxelGrid(tm.voxel.encoding.SparseBinaryEncoding(indices - origin),
+                              transform=tm.transformations.scale_and_translate(scale=pitch,
+                                                                               translate=origin * pitch))
+    if mode == 'volume':
+        grid = grid.fill()
+    elif mode != 'surface':
+        raise ValueError(f"unknown sampling mode: {mode}")
+    return grid.points
+
+
+# (n, 3) float32 particle positions sampled from the mesh at @mesh_path
+def sample_mesh(mesh_path, scale, displacement, pitch, mode='volume', cache_dir='./cache', workers=0):
+    path = None
+    if cache_dir:
+        path = cache_path(cache_dir, cache_key(mesh_path, scale, displacement, pitch, mode))
+        if os.path.exists(path):
+            return np.load(path)
+
+    mesh = tm.load(mesh_path)
+    mesh.vertices *= scale
+    mesh.vertices += np.array(displacement)
+    points = voxelize(mesh, pitch, mode, workers).astype(np.float32)
+
+    if path is not None:
+        # write to a temporary file first, concurrent launches never read a half written entry
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, points)
+        os.replace(tmp_path, path)
+    return points
+
+
+# signed distance to the union of the particle spheres (radius pitch / 2) sampled at the particle grid of spacing
+# @pitch, negative inside, covering @margin around them. Returns the position of sample [0, 0, 0] and the samples.
+def distance_field(points, pitch, margin):
+    indices = np.round(points / pitch).astype(np.int64)
+    pad = int(np.ceil(margin / pitch)) + 1
+    origin = indices.min(axis=0) - pad
+    occupied = np.zeros(indices.max(axis=0) - origin + pad + 1, dtype=bool)
+    occupied[tuple((indices - origin).T)] = True
+    # distance between cell centers, the surface lies half a cell away from the last occupied center
+    outside = ndimage.distance_transform_edt(~occupied)
+    inside = ndimage.distance_transform_edt(occupied)
+    sdf = np.where(occupied, 0.5 - inside, outside - 0.5) * pitch
+    return origin * pitch, sdf.astype(np.float32)
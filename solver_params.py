@@ -0,0 +1,62 @@
+# Solver parameters that can be changed between steps without recompiling the kernels.
+# The values live in a scalar struct field that the kernels read, instead of being baked in as config.py constants.
+import taichi as ti
+import config
+
+# tunable parameters, initialized from config.py
+names = ['h', 'lambda_epsilon', 'corrK', 'corr_deltaQ_coeff', 'XSPH_c', 'vorticity_confinement_epsilon',
+         'mass', 'rho0', 'gravity']
+
+
+@ti.data_oriented
+class solver_params:
+    def __init__(self):
+        members = {name: float for name in names}
+        members['gravity'] = ti.types.vector(config.dim, float)
+        # derived from the parameters above, refreshed by set
+        members['neighbor_search_radius'] = float
+        members['scorr_denominator'] = float
+        # constants of the SPH kernels, see config.poly6_value
+        members['h2'] = float
+        members['poly6_coeff'] = float
+        members['spiky_coeff'] = float
+        self.field = ti.Struct.field(members, shape=())
+        self.values = {}
+        # bumped whenever the neighbor search radius changes, pbf rebuilds the neighbor lists kept for reuse then
+        self.version = 0
+        self.search_radius = None
+        self.set(**{name: getattr(config, name) for name in names})
+
+    # sets the given parameters, they take effect at the next kernel launch
+    def set(self, **values):
+        for name in values:
+            if name not in names:
+                raise KeyError(f"not a runtime parameter: {name}")
+        if 'gravity' in values:
+            values['gravity'] = [float(v) for v in values['gravity']]
+        updated = dict(self.values, **values)
+        # same as config.neighbor_search_radius
+        search_radius = updated['h'] * config.neighbour_radius_ratio + config.neighbor_skin
+        # the neighbor search only visits the 27 surrounding cells
+        if search_radius > config.cell_size:
+            raise ValueError(f"neighbour_radius + neighbor_skin ({search_radius}) exceeds cell_size ({config.cell_size})")
+        self.values = updated
+        for name, value in values.items():
+            getattr(self.field, name)[None] = value
+        if search_radius != self.search_radius:
+            self.search_radius = search_radius
+            self.field.neighbor_search_radius[None] = search_radius
+            self.version += 1
+        self.refresh()
+
+    def get(self, name):
+        return self.values[name]
+
+    @ti.kernel
+    def refresh(self):
+        h = self.field[None].h
+        self.field[None].h2 = h * h
+        self.field[None].poly6_coeff = config.poly6_factor / h ** 9
+        self.field[None].spiky_coeff = config.spiky_grad_factor / h ** 6
+        p = self.field[None]
+        self.field[None].scorr_denominator = config.poly6_value(p.corr_deltaQ_coeff * p.h, p)
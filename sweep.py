@@ -0,0 +1,174 @@
+# Parameter sweep. Runs every combination of a parameter grid headless, one process per run,
+# several runs in parallel, and collects wall time, density error and max velocity per run.
+# usage: python sweep.py --grid "lambda_epsilon=[10, 100, 1000]" --grid "corrK=[0.001, 0.01]" --workers 4
+#        python sweep.py --grid "pdf_num_iters=[2, 3, 5]" --set cell_list_mode=compact --steps 500 --out sweep.json
+import argparse
+import datetime
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import config
+from headless_main import parse_override
+from benchmark import git_revision
+
+
+def run_config(overrides, arch, threads, cache_dir, steps, warmup, sample_interval):
+    # runs in a fresh process: config has to be overridden before the solver modules are imported
+    config.configure(**overrides)
+    import taichi as ti
+    from headless_main import init_taichi, build_simulation
+    # all workers share one offline cache, a configuration compiled once is loaded from disk by the others
+    init_taichi(arch, threads, offline_cache=True, offline_cache_file_path=cache_dir)
+    ps, solver = build_simulation()
+
+    for _ in range(warmup):
+        solver.run_PBF()
+    ti.sync()
+
+    max_errors, mean_errors, max_speeds = [], [], []
+    sample_time = 0.0
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        solver.run_PBF()
+        if step % sample_interval == 0 or step == steps:
+            t = time.perf_counter()
+            e_max, e_mean = solver.measure_density_error()
+            max_errors.append(float(e_max))
+            mean_errors.append(float(e_mean))
+            max_speeds.append(float(solver.max_speed()))
+            sample_time += time.perf_counter() - t
+    ti.sync()
+    wall_time = time.perf_counter() - start - sample_time
+
+    finite = all(math.isfinite(v) for v in max_errors + max_speeds)
+    return {
+        'wall_time': wall_time,
+        'steps_per_sec': steps / wall_time,
+        'solver_steps': solver.num_steps,
+        'max_density_error': max(max_errors),
+        'mean_density_error': float(np.mean(mean_errors)),
+        'final_mean_density_error': mean_errors[-1],
+        'max_velocity': max(max_speeds),
+        # nan or inf somewhere, the configuration blew up
+        'stable': finite,
+    }
+
+
+def expand_grid(grid):
+    names = [name for name, _ in grid]
+    values = [v if isinstance(v, (list, tuple)) else [v] for _, v in grid]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def run(args):
+    import taichi as ti
+    configs = expand_grid(args.grid)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    cache_dir = os.path.abspath(args.cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'taichi': '.'.join(str(v) for v in ti.__version__),
+            'arch': args.arch,
+            'workers': args.workers,
+            'threads_per_worker': threads,
+            'steps': args.steps,
+            'warmup': args.warmup,
+            'overrides': dict(args.overrides),
+        },
+        'runs': [],
+    }
+    print(f"{len(configs)} configurations on {args.workers} workers with {threads} threads each")
+
+    start = time.perf_counter()
+    ctx = multiprocessing.get_context('spawn')
+    # one process per run, the kernels are compiled against the overridden config
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx, max_tasks_per_child=1) as executor:
+        futures = {}
+        for params in configs:
+            overrides = dict(args.overrides)
+            overrides.update(params)
+            future = executor.submit(run_config, overrides, args.arch, threads, cache_dir,
+                                     args.steps, args.warmup, args.sample_interval)
+            futures[future] = params
+        for future in as_completed(futures):
+            entry = {'params': futures[future]}
+            try:
+                entry['metrics'] = future.result()
+            except Exception as e:
+                # a failing configuration does not stop the sweep
+                entry['error'] = f"{type(e).__name__}: {e}"
+            report['runs'].append(entry)
+            print_run(entry)
+    report['meta']['total_time'] = time.perf_counter() - start
+
+    # same order as the grid
+    order = {json.dumps(params, sort_keys=True): i for i, params in enumerate(configs)}
+    report['runs'].sort(key=lambda entry: order[json.dumps(entry['params'], sort_keys=True)])
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"{len(configs)} runs in {report['meta']['total_time']:.1f} s, results written to {args.out}")
+    print_table(report['runs'])
+
+
+def format_params(params):
+    return '  '.join(f"{name}={value}" for name, value in params.items())
+
+
+def print_run(entry):
+    if 'error' in entry:
+        print(f"{format_params(entry['params'])}: failed, {entry['error']}")
+        return
+    m = entry['metrics']
+    print(f"{format_params(entry['params'])}: {m['wall_time']:.2f} s  max error {m['max_density_error']:.3g}  "
+          f"mean error {m['mean_density_error']:.3g}  max velocity {m['max_velocity']:.3g}"
+          f"{'' if m['stable'] else '  UNSTABLE'}")
+
+
+def print_table(runs):
+    names = list(runs[0]['params']) if runs else []
+    columns = ['wall_time', 'max_density_error', 'mean_density_error', 'max_velocity']
+    print('  '.join(f"{name:>16}" for name in names + columns))
+    for entry in runs:
+        cells = [f"{str(entry['params'][name]):>16}" for name in names]
+        if 'metrics' in entry:
+            cells += [f"{entry['metrics'][c]:16.4g}" for c in columns]
+        else:
+            cells.append(f"{'failed':>16}")
+        print('  '.join(cells))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run a grid of PBF configurations in parallel.')
+    parser.add_argument('--grid', type=parse_override, action='append', default=[], metavar='NAME=[V1, V2, ...]',
+                        help='values of a parameter of config.py, every combination of all --grid options is run')
+    parser.add_argument('--set', dest='overrides', type=parse_override, action='append', default=[],
+                        metavar='NAME=VALUE', help='override a parameter of config.py for every run')
+    parser.add_argument('--workers', type=int, default=2, help='runs in parallel')
+    parser.add_argument('--threads', type=int, default=0, help='cpu threads per run, 0 splits the cores evenly')
+    parser.add_argument('--arch', default='cpu')
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=1, help='steps before the timing starts')
+    parser.add_argument('--sample-interval', type=int, default=10, help='steps between metric samples')
+    parser.add_argument('--cache-dir', default='./cache/taichi', help='offline kernel cache shared by the runs')
+    parser.add_argument('--out', default='sweep.json')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for name, _ in args.grid + args.overrides:
+        if not hasattr(config, name):
+            raise SystemExit(f"unknown config parameter: {name}")
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
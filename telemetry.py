@@ -0,0 +1,75 @@
+# Per-step metrics of the solver. pbf.run_PBF hands a record to the sink every telemetry_interval steps,
+# the metrics are reduced on the device and read back in one go, the phases are timed on those steps only.
+import contextlib
+import csv
+import json
+import os
+import time
+import taichi as ti
+
+
+class phase_timer:
+    def __init__(self):
+        # phases are only timed while enabled, the syncs around them would stall the pipeline otherwise
+        self.enabled = False
+        self.times = {}
+        # trace_profiler that gets every phase, see profiler.py
+        self.profiler = None
+
+    # adds the wall time of the block to self.times[name]
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled and self.profiler is None:
+            yield
+            return
+        ti.sync()
+        start = time.perf_counter()
+        yield
+        ti.sync()
+        end = time.perf_counter()
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0.0) + end - start
+        if self.profiler is not None:
+            self.profiler.add_scope(name, start, end)
+
+    def reset(self):
+        self.times = {}
+
+
+# nested dicts and lists become flat columns: {'phases': {'solver': t}} -> phases_solver, [a, b] -> name_0, name_1
+def flatten(record, prefix=''):
+    columns = {}
+    for name, value in record.items():
+        if isinstance(value, (list, tuple)):
+            value = {str(i): v for i, v in enumerate(value)}
+        if isinstance(value, dict):
+            columns.update(flatten(value, f"{prefix}{name}_"))
+        else:
+            columns[f"{prefix}{name}"] = value
+    return columns
+
+
+class telemetry_sink:
+    # @path: .jsonl - one json object per line, .csv - flattened columns, taken from the first record
+    def __init__(self, path):
+        self.format = os.path.splitext(path)[1].lower()
+        if self.format not in ('.jsonl', '.csv'):
+            raise ValueError(f"unknown telemetry format: {path}, use .jsonl or .csv")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'w', newline='')
+        self.csv_writer = None
+
+    def write(self, record):
+        if self.format == '.jsonl':
+            self.file.write(json.dumps(record) + '\n')
+        else:
+            columns = flatten(record)
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.file, fieldnames=list(columns), extrasaction='ignore')
+                self.csv_writer.writeheader()
+            self.csv_writer.writerow(columns)
+        # records are rare, keep the file readable while the run goes on
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
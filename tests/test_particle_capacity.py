@@ -0,0 +1,46 @@
+# Runs the headless runner with more particle slots than particles. Each run is a subprocess,
+# config.py is copied into the modules at import and cannot be changed within one process.
+import glob
+import os
+import subprocess
+import sys
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_headless(tmp_path, *args):
+    command = [sys.executable, os.path.join(root, 'headless_main.py'), '--warmup', '0', '--log-interval', '0',
+               '--output-dir', str(tmp_path / 'frames'), '--checkpoint-dir', str(tmp_path / 'checkpoints'),
+               '--set', 'particle_capacity=12000', '--set', 'reorder_interval=1'] + list(args)
+    result = subprocess.run(command, cwd=root, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result.stdout
+
+
+def num_fluid_particles():
+    sys.path.insert(0, root)
+    import config
+    return config.N_fluid_particles
+
+
+def test_reorder_export_and_resume_with_free_slots(tmp_path):
+    n = num_fluid_particles()
+    assert n < 12000
+    run_headless(tmp_path, '--steps', '4', '--output-interval', '2', '--format', 'npz', '--checkpoint-interval', '2')
+    frames = sorted(glob.glob(str(tmp_path / 'frames' / '*.npz')))
+    assert len(frames) == 2
+    for path in frames:
+        with np.load(path) as frame:
+            # only the particles in use, the free slots never get sorted in
+            assert frame['positions'].shape == (n, 3)
+            assert np.isfinite(frame['positions']).all()
+            assert (np.abs(frame['positions']).sum(axis=1) > 0).all()
+
+    with np.load(str(tmp_path / 'checkpoints' / 'checkpoint_00000004.npz')) as checkpoint:
+        assert int(checkpoint['num_particles']) == n
+        assert sorted(checkpoint['particle_ids']) == list(range(n))
+
+    output = run_headless(tmp_path, '--steps', '6', '--output-interval', '2', '--format', 'npz', '--resume')
+    assert 'resumed from' in output
+    assert len(glob.glob(str(tmp_path / 'frames' / '*.npz'))) == 3
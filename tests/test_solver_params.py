@@ -0,0 +1,34 @@
+# Runtime parameter changes. The simulation runs in a subprocess, see test_particle_capacity.py.
+import os
+import subprocess
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# counts the neighbors after the prologue that follows set(h=1.6), then after a forced rebuild.
+# The lists are built in step 6 and the skin is wide enough to reuse them in step 7.
+changed_h_script = '''
+import config
+config.configure(neighbor_skin=0.8)
+from headless_main import init_taichi, build_simulation
+init_taichi()
+ps, solver = build_simulation()
+for _ in range(6):
+    solver.run_PBF()
+builds = solver.num_neighbor_builds
+solver.params.set(h=1.6)
+solver.prologue()
+n = ps.num_particles[None]
+reused = ps.particle_num_neighbors.to_numpy()[:n].sum()
+solver.update_neighbors()
+rebuilt = ps.particle_num_neighbors.to_numpy()[:n].sum()
+print(solver.num_neighbor_builds - builds, reused, rebuilt)
+'''
+
+
+def test_changing_h_rebuilds_the_neighbor_lists():
+    result = subprocess.run([sys.executable, '-c', changed_h_script], cwd=root, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    new_builds, reused, rebuilt = map(int, result.stdout.split()[-3:])
+    assert new_builds == 1
+    assert reused == rebuilt
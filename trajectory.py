@@ -0,0 +1,101 @@
+# Append-only trajectory file with a fixed-stride layout for random frame access.
+# layout: 64 byte header, then one contiguous little endian float32 block of num_particles x components per frame.
+# The reader maps the file into memory, frames are returned as numpy views without copies or parsing.
+import os
+import struct
+import numpy as np
+
+magic = b'PBFTRAJ\0'
+version = 1
+# magic, version, num_particles, components, padded to header_size
+header_format = '<8sIQI'
+header_size = 64
+
+
+def read_header(f):
+    data = f.read(header_size)
+    if len(data) < header_size:
+        raise ValueError(f"{f.name} is not a trajectory file: header is truncated")
+    file_magic, file_version, num_particles, components = struct.unpack_from(header_format, data)
+    if file_magic != magic:
+        raise ValueError(f"{f.name} is not a trajectory file")
+    if file_version != version:
+        raise ValueError(f"{f.name}: unsupported trajectory version {file_version}")
+    return num_particles, components
+
+
+class trajectory_writer:
+    # opens an existing trajectory for appending, or creates a new one
+    def __init__(self, path, num_particles, components=3):
+        self.path = path
+        self.num_particles = num_particles
+        self.components = components
+        self.frame_size = num_particles * components * 4
+        if os.path.exists(path) and os.path.getsize(path) >= header_size:
+            with open(path, 'rb') as f:
+                if read_header(f) != (num_particles, components):
+                    raise ValueError(f"{path} holds frames of a different shape")
+            self.file = open(path, 'r+b')
+            # drop a partially written last frame
+            self.num_frames = (os.path.getsize(path) - header_size) // self.frame_size
+            self.file.truncate(header_size + self.num_frames * self.frame_size)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'w+b')
+            header = struct.pack(header_format, magic, version, num_particles, components)
+            self.file.write(header.ljust(header_size, b'\0'))
+            self.num_frames = 0
+        self.file.seek(0, os.SEEK_END)
+
+    # writes frame @index, frames from @index on are discarded first (e.g. after restarting from a checkpoint)
+    def write_frame(self, index, data):
+        if index > self.num_frames:
+            raise ValueError(f"frame {index} would leave a gap after frame {self.num_frames - 1}")
+        if index < self.num_frames:
+            self.file.truncate(header_size + index * self.frame_size)
+            self.file.seek(0, os.SEEK_END)
+            self.num_frames = index
+        data = np.ascontiguousarray(data, dtype='<f4')
+        if data.size != self.num_particles * self.components:
+            raise ValueError(f"frame has {data.size} values, expected {self.num_particles * self.components}")
+        data.tofile(self.file)
+        self.file.flush()
+        self.num_frames += 1
+
+    def append(self, data):
+        self.write_frame(self.num_frames, data)
+
+    def close(self):
+        self.file.close()
+
+
+class trajectory_reader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.num_particles, self.components = read_header(f)
+        self.frame_size = self.num_particles * self.components * 4
+        self.refresh()
+
+    # maps the frames written so far, call again to see frames appended after opening
+    def refresh(self):
+        self.num_frames = (os.path.getsize(self.path) - header_size) // self.frame_size
+        if self.num_frames == 0:
+            self.data = np.empty((0, self.num_particles, self.components), dtype='<f4')
+        else:
+            self.data = np.memmap(self.path, dtype='<f4', mode='r', offset=header_size,
+                                  shape=(self.num_frames, self.num_particles, self.components))
+
+    def __len__(self):
+        return self.num_frames
+
+    # (num_particles, components) view of frame @i
+    def frame(self, i):
+        return self.data[i]
+
+    # (stop - start, num_particles, components) view of the frames start ... stop - 1
+    def frames(self, start=0, stop=None, step=1):
+        return self.data[start:stop:step]
+
+    def __getitem__(self, key):
+        return self.data[key]